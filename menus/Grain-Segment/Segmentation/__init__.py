@@ -1,14 +1,120 @@
-class Transfer:
-    """Storage class for exchanging variables.
-       ...
+from collections import OrderedDict
 
+import numpy as np
+
+
+class Workspace:
+    """Outputs of the workflow steps, shared by the plugins.
+
+    Each output (stage) is held once. The plugins get read-only views of the
+    arrays, so that a stage cannot be modified by accident and does not need
+    to be copied defensively. Storing a stage discards the stages computed
+    from its previous value, which are stale. The upstream stages are kept,
+    so that any step can be rerun with other parameters, e.g. the merging of
+    the clusters with another threshold without rerunning the quick shift
+    segmentation. Use `release`, or set `keep`, to free them.
+
+    Attributes
+    ----------
+    keep : int or None
+        When set, storing a stage also releases the stages more than `keep`
+        steps upstream of it, with everything computed from them, so that the
+        memory use does not grow with the number of steps run. The original
+        image is always kept. None (the default) keeps all the upstream stages.
     """
 
+    # Each stage and the stages it is computed from
+    STAGES = OrderedDict([
+        ('original_image', ()),
+        ('segment_mask', ('original_image',)),
+        ('renderer', ('original_image', 'segment_mask')),
+        ('merge_tree', ('original_image', 'segment_mask')),
+        ('merged_superpixels', ('segment_mask', 'merge_tree')),
+        # The boundaries and the watershed labels are only shown, no step reads them back
+        ('skeleton_image', ('merged_superpixels',)),
+        ('incremental', ('merged_superpixels',)),
+        ('corrected', ('incremental',)),
+    ])
+
+    def __init__(self, keep=None):
+        self.keep = keep
+        self._data = {}
+
+    def __contains__(self, name):
+        return name in self._data
+
+    def get(self, name, writable=False):
+        """The output of a stage; arrays are returned as read-only views.
+
+        Only the step owning a stage should ask for it `writable`, to update it
+        in place.
+        """
+        if name not in self._data:
+            raise Exception('{0} is not available. Run the step computing it first.'.format(name))
+        value = self._data[name]
+        if isinstance(value, np.ndarray) and not writable:
+            value = value.view()
+            value.flags.writeable = False
+        return value
+
+    def put(self, name, value):
+        """Store the output of a stage, without copying it.
+
+        Returns
+        -------
+        The stored value, as returned by `get`.
+        """
+
+        if name not in self.STAGES:
+            raise Exception('Unknown stage {0}. Choose from: {1}.'.format(name, list(self.STAGES)))
+        self.release(*self.dependents(name)[1:])
+        self._data[name] = value
+        if self.keep is None:
+            return self.get(name)
+        ancestors = self.ancestors(name)
+        distant = [stage for stage, distance in ancestors.items()
+                   if distance > self.keep and stage != 'original_image']
+        for stage in distant:
+            self.release(stage, *[dependent for dependent in self.dependents(stage)
+                                  if dependent != name and dependent not in ancestors])
+        return self.get(name)
+
+    def release(self, *names):
+        """Discard the outputs of stages."""
+        for name in names:
+            self._data.pop(name, None)
+
+    def clear(self):
+        """Discard everything, the original image included."""
+        self._data.clear()
+
+    def dependents(self, name):
+        """The stage and all the stages computed from it."""
+        found = [name]
+        for stage, inputs in self.STAGES.items():  # inputs are always listed before their dependents
+            if any(input_name in found for input_name in inputs):
+                found.append(stage)
+        return found
+
+    def ancestors(self, name):
+        """Stages a stage is computed from, with their distance in steps."""
+        distances = {}
+        front, distance = [name], 0
+        while front:
+            distance += 1
+            front = [input_name for stage in front for input_name in self.STAGES[stage]
+                     if input_name not in distances]
+            for stage in front:
+                distances[stage] = distance
+        return distances
+
     def attributes(self):
-        """Prints currently contained data members."""
-        print('Currently the following attributes are available: ', list(vars(self).keys()))
+        """Prints the stages currently held and their size."""
+        print('Currently the following stages are available: ',
+              ['{0} ({1:.1f} MB)'.format(name, getattr(value, 'nbytes', 0) / 2**20)
+               for name, value in self._data.items()])
 
 
-storage = Transfer()
+workspace = Workspace()
 
 catlog = ['Workflow', 'Demos', 'Help', '-']
@@ -0,0 +1,97 @@
+"""
+Boundaries of the regions of a label image, in one vectorized pass.
+
+The usual workflow finds thick boundaries (both pixels of every pair of
+neighbours with different labels) and thins them to a one-pixel wide skeleton
+by iterative thinning. Marking only one pixel of each pair, the one on the
+top or on the left, gives a one-pixel wide boundary network directly. It
+still separates the regions: two side neighbours with different labels are
+never both unmarked, so the unmarked pixels of different regions are not
+connected (with 4-connectivity), as the watershed segmentation requires.
+
+The labels may also be given as colours (the channels in the last
+dimension), e.g. the merged image after manual corrections.
+"""
+
+import numpy as np
+
+
+def _differences(image, axis):
+    """Whether each pixel differs from its next neighbour along an axis (2D, one shorter along it)."""
+    first = [slice(None), slice(None)]
+    second = [slice(None), slice(None)]
+    first[axis], second[axis] = slice(None, -1), slice(1, None)
+    different = image[tuple(first)] != image[tuple(second)]
+    if different.ndim == 3:
+        different = different.any(axis=2)
+    return tuple(first), tuple(second), different
+
+
+def thick_boundaries(image):
+    """Pixels having a side neighbour of another label.
+
+    Same as `skimage.segmentation.find_boundaries(labels)`.
+    """
+
+    boundary = np.zeros(image.shape[:2], dtype=bool)
+    for axis in (0, 1):
+        first, second, different = _differences(image, axis)
+        boundary[first] |= different
+        boundary[second] |= different
+    return boundary
+
+
+def thin_boundaries(image, out=None):
+    """One-pixel wide boundaries, without thinning.
+
+    A pixel is on the boundary when its right or bottom neighbour has another
+    label.
+
+    Parameters
+    ----------
+    image : ndarray
+        Label image, or colour image whose colours identify the regions.
+    out : bool ndarray, optional
+        Array to write the result into.
+
+    Returns
+    -------
+    bool ndarray
+        The boundary network, to be used instead of the skeleton of the
+        thick boundaries.
+    """
+
+    if out is None:
+        out = np.zeros(image.shape[:2], dtype=bool)
+    else:
+        out[...] = False
+    for axis in (0, 1):
+        first, _, different = _differences(image, axis)
+        out[first] |= different
+    return out
+
+
+def agreement(reference, labels):
+    """Fraction of the pixels on which two segmentations agree.
+
+    Each label of `labels` is paired with the label of `reference` it overlaps
+    most, each reference label being used once, largest overlaps first. The
+    agreement is the fraction of the pixels covered by the paired labels, 1
+    for identical partitions whatever the label values are.
+    """
+
+    reference = np.asarray(reference, dtype=np.int64).ravel()
+    labels = np.asarray(labels, dtype=np.int64).ravel()
+    width = int(reference.max()) + 1
+    pairs, counts = np.unique(labels * width + reference, return_counts=True)
+    pair_labels, pair_reference = np.divmod(pairs, width)
+    order = np.argsort(-counts, kind='mergesort')
+    used_labels, used_reference = set(), set()
+    matched = 0
+    for label, ref, count in zip(pair_labels[order], pair_reference[order], counts[order]):
+        if label in used_labels or ref in used_reference:
+            continue
+        used_labels.add(label)
+        used_reference.add(ref)
+        matched += count
+    return matched / reference.size
@@ -0,0 +1,120 @@
+"""
+Merge tree (single-linkage dendrogram) of a Region Adjacency Graph.
+
+Cutting a RAG at a threshold merges the regions connected by edges lighter
+than the threshold. Instead of cutting the graph again for every threshold,
+the edges are sorted once and folded into a union-find forest. The label image
+belonging to any threshold is then obtained with a single lookup table.
+"""
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+class MergeTree:
+    """Threshold-independent representation of `graph.cut_threshold`.
+
+    Attributes
+    ----------
+    weights : ndarray
+        Sorted weights of the edges along which two regions get merged.
+    n_labels : int
+        One more than the largest label in the graph.
+    """
+
+    def __init__(self, rag):
+        """Build the merge tree from a region adjacency graph.
+
+        Parameters
+        ----------
+        rag : RAG
+            Region adjacency graph, for example the output of
+            `graph.rag_mean_color`. Edges must have a 'weight' attribute.
+        """
+
+        nodes = np.fromiter(rag.nodes(), dtype=np.intp, count=rag.number_of_nodes())
+        self.n_labels = int(nodes.max()) + 1 if nodes.size else 0
+        edges = [(u, v, d['weight']) for u, v, d in rag.edges(data=True)]
+        sources = np.array([e[0] for e in edges], dtype=np.intp)
+        targets = np.array([e[1] for e in edges], dtype=np.intp)
+        weights = np.array([e[2] for e in edges], dtype=float)
+        order = np.argsort(weights, kind='mergesort')
+        # Kruskal's algorithm: only the edges joining two different trees are kept
+        parent = np.arange(self.n_labels)
+
+        def find(node):
+            root = node
+            while parent[root] != root:
+                root = parent[root]
+            while parent[node] != root:  # path compression
+                parent[node], node = root, parent[node]
+            return root
+
+        kept = []
+        for edge in order:
+            root_u, root_v = find(sources[edge]), find(targets[edge])
+            if root_u != root_v:
+                parent[root_u] = root_v
+                kept.append(edge)
+        kept = np.array(kept, dtype=np.intp)
+        self._sources = sources[kept]
+        self._targets = targets[kept]
+        self.weights = weights[kept]
+        self._nodes = nodes
+
+    @property
+    def nbytes(self):
+        """Memory occupied by the tree."""
+        return self._sources.nbytes + self._targets.nbytes + self.weights.nbytes + self._nodes.nbytes
+
+    def lookup_table(self, threshold):
+        """Mapping from the original labels to the merged labels.
+
+        Parameters
+        ----------
+        threshold : float
+            Regions connected by edges with smaller weights are combined.
+
+        Returns
+        -------
+        lut : ndarray
+            `lut[label]` is the merged label of `label`. The merged labels are
+            consecutive integers starting from 0.
+        """
+
+        n_merges = np.searchsorted(self.weights, threshold, side='left')
+        adjacency = coo_matrix((np.ones(n_merges, dtype=np.int8),
+                                (self._sources[:n_merges], self._targets[:n_merges])),
+                               shape=(self.n_labels, self.n_labels))
+        _, components = connected_components(adjacency, directed=False)
+        # Labels not present in the graph also form components: number the others consecutively
+        lut = np.zeros(self.n_labels, dtype=np.intp)
+        _, lut[self._nodes] = np.unique(components[self._nodes], return_inverse=True)
+        return lut
+
+    def cut(self, labels, threshold, out=None, dtype=None):
+        """Label image obtained by merging the regions below a threshold.
+
+        Parameters
+        ----------
+        labels : ndarray
+            Label image the RAG was built from.
+        threshold : float
+            Regions connected by edges with smaller weights are combined.
+        out : int ndarray, optional
+            Array of the shape of `labels` to write the result into.
+        dtype : data-type, optional
+            Type of the result when `out` is not given, e.g. a small unsigned
+            type (see `labelling.label_dtype`). Defaults to np.intp.
+
+        Returns
+        -------
+        ndarray
+            The new labelled array, partitioned as by `graph.cut_threshold`.
+        """
+
+        lut = self.lookup_table(threshold)
+        if out is None:
+            return lut.astype(dtype or np.intp, copy=False)[labels]
+        return np.take(lut.astype(out.dtype, copy=False), labels, out=out, mode='clip')
@@ -1,41 +1,29 @@
 import numpy as np
-from scipy.ndimage import median_filter
 from scipy.ndimage.morphology import distance_transform_edt
-from skimage import data, io, segmentation, color, measure
+from skimage import data, io, segmentation
 from skimage.morphology import skeletonize, watershed
 from skimage.future import graph
-from imagepy.core import ImagePlus
 from imagepy.core.engine import Filter, Simple
 from imagepy.core.manager import ImageManager
 from imagepy.core.util import fileio
 from imagepy import IPy
 from imagepy.menus.Process.Segment.shift_plgs import Quickshift
 from imagepy.menus.Process.Filters.classic_plgs import Median
-from imagepy.menus.Image.Type.convert_plg import ToInt32
-from imagepy.menus.Image.duplicate_plg import Duplicate
 from imagepy.menus.Process.Segment.graph_plgs import RagThreshold
 from imagepy.menus.Process.Binary.distance_plgs import Skeleton
 from imagepy.menus.Analysis.label_plg import Boundaries
 
-from .gala_light import imextendedmin
+from .boundaries import thick_boundaries, thin_boundaries
+from .gala_light import extended_minima_markers
+from .median_filter import median_filter
+from .tiling import quickshift_tiled
+from .merge_tree import MergeTree
+from .rendering import MeanColorRenderer
+from .incremental import IncrementalSegmentation
 
 
-class DuplicateNoGUI(Duplicate):
-
-    @classmethod
-    def copy(cls, ips, name):
-        img = ips.img.copy()
-        ipsd = ImagePlus([img], name)
-        ipsd.back = ips.back
-        ipsd.chan_mode = ips.chan_mode
-        cls.para['name'] = name
-        IPy.show_ips(ipsd)
-        return ipsd
-
-    def run(self, ips, imgs, para=None):
-        pass
-
-    pass
+# Fixed colours of the labels, so that a grain keeps its colour when the labels are updated
+palette = np.random.RandomState(0).randint(64, 256, (256, 3)).astype(np.uint8)
 
 
 class OpenImage(fileio.Reader):
@@ -44,20 +32,21 @@ class OpenImage(fileio.Reader):
     filt = ['bmp', 'jpeg', 'jpg', 'png', 'tif']  # supported image formats
 
     def run(self, para=None):
-        from . import storage
-        storage.original_image = io.imread(para['path'])
+        from . import workspace
+        workspace.clear()  # a new workflow starts
+        workspace.put('original_image', io.imread(para['path']))
         super().run(para)
 
 
 class FilterImage(Median):
-    """Median filtering of the current image."""
+    """Median filtering of the current image, channel by channel."""
     title = 'Filter image'
     para = {'size': 5}
 
     def load(self, ips):
         super().load(ips)
-        ips.data = DuplicateNoGUI.copy(ips, ips.title)  # create a copy from the original image
-        ips.title = ips.title + '-filtered'  # rename original image
+        # The original image is kept in the workspace, so the image is filtered in place instead of in a copy
+        ips.title = ips.title + '-filtered'
         return True
 
     def run(self, ips, snap, img, para = None):
@@ -66,16 +55,26 @@ class FilterImage(Median):
 
 class InitialSegmentation(Quickshift):
     title = 'Quick shift segmentation'
+    para = dict(Quickshift.para, workers=1)
+    view = Quickshift.view + [(int, 'workers', (1, 256), 0, 'workers', 'threads')]
 
     def run(self, ips, snap, img, para=None):
-        from . import storage
-        segment_mask = segmentation.quickshift(snap, para['ratio'], para['kernel_size'], para['max_dist'],
-                                               para['sigma'])
-        # Save the label image before plotting it (we will use it in the later steps)
-        storage.segment_mask = segment_mask
+        from . import workspace
+        kwargs = {'ratio': para['ratio'], 'kernel_size': para['kernel_size'], 'max_dist': para['max_dist'],
+                  'sigma': para['sigma']}
+        if para['workers'] > 1:
+            # Overlapping tiles are segmented in parallel, then stitched together
+            segment_mask = quickshift_tiled(snap, workers=para['workers'], **kwargs)
+        else:
+            segment_mask = segmentation.quickshift(snap, **kwargs)
+        # Save the label image before plotting it (we will use it in the later steps). The merge tree and the
+        # corrections of the previous label image are discarded.
+        segment_mask = workspace.put('segment_mask', segment_mask)
+        # The colour sums of the superpixels are reused when rendering the merged superpixels
+        renderer = workspace.put('renderer', MeanColorRenderer(workspace.get('original_image'), segment_mask))
         print(np.amax(segment_mask))
         # The final image is opened on a new tab
-        IPy.show_img([color.label2rgb(segment_mask, storage.original_image, kind='avg')], ips.title + '-segmented')
+        IPy.show_img([renderer.render()], ips.title + '-segmented')
 
 
 class MergeClusters(RagThreshold):
@@ -89,72 +88,128 @@ class MergeClusters(RagThreshold):
             (list, 'mode', ['distance', 'similarity'], str, 'mode', ''),
             (float, 'sigma', (0, 1024), 1, 'sigma', 'similarity')]
 
-    def preview(self, ips, para):
-        from . import storage
+    @staticmethod
+    def merge(para):
+        """Merge the superpixels, building the merge tree only when the graph parameters change.
+
+        The merged label image is stored, and the lookup table from the superpixels to the merged labels is returned.
+        """
+        from . import workspace
         connect = ['4-connected', '8-connected'].index(para['connect']) + 1
-        g = graph.rag_mean_color(storage.original_image, storage.segment_mask, connect, para['mode'], para['sigma'])
-        merged_superpixels = graph.cut_threshold(storage.segment_mask, g, para['thresh'], in_place = False)
-        storage.merged_superpixels = merged_superpixels
-        print(np.amax(storage.merged_superpixels))
+        key = (connect, para['mode'], para['sigma'])
+        segment_mask = workspace.get('segment_mask')
+        if 'merge_tree' not in workspace or workspace.get('merge_tree')[0] != key:
+            g = graph.rag_mean_color(workspace.get('original_image'), segment_mask, connect, para['mode'],
+                                     para['sigma'])
+            workspace.put('merge_tree', (key, MergeTree(g)))
+        # Moving the threshold slider only costs a lookup table applied on the label image
+        lut = workspace.get('merge_tree')[1].lookup_table(para['thresh'])
+        merged_superpixels = workspace.put('merged_superpixels', lut[segment_mask])
+        print(np.amax(merged_superpixels))
+        return lut
+
+    def preview(self, ips, para):
+        from . import workspace
+        lut = self.merge(para)
         # The image preview is displayed on the current image. By changing the `img` attribute of `ips`, the image
-        # update callback is invoked
-        ips.img[:] = color.label2rgb(merged_superpixels, storage.original_image, kind = 'avg')
+        # update callback is invoked. The colours of the merged regions come from the sums of the superpixels.
+        workspace.get('renderer').render(lut, out=ips.img)
 
     def run(self, ips, imgs, para=None):
-        from . import storage
-        connect = ['4-connected', '8-connected'].index(para['connect']) + 1
-        g = graph.rag_mean_color(storage.original_image, storage.segment_mask, connect, para['mode'], para['sigma'])
-        merged_superpixels = graph.cut_threshold(storage.segment_mask, g, para['thresh'], in_place = False)
-        storage.merged_superpixels = merged_superpixels
-        print(np.amax(storage.merged_superpixels))
+        from . import workspace
+        lut = self.merge(para)
         # The final image is opened on a new tab
-        IPy.show_img([color.label2rgb(merged_superpixels, storage.original_image, kind = 'avg')], '-merged')
+        IPy.show_img([workspace.get('renderer').render(lut)], '-merged')
 
 
 class FindGrainBoundaries(Boundaries):
+    """Boundaries of the regions of the merged image.
+
+    With `thin`, one-pixel wide boundaries are found directly and stored as the skeleton, so that the watershed
+    segmentation can follow without `CreateSkeleton`.
+    """
     title = 'Find grain boundaries'
     note = ['all']
+    para = {'thin': False}
+    view = [(bool, 'thin', 'one pixel wide, no skeleton needed')]
 
     def run(self, ips, imgs, para=None):
-        from . import storage
-        # RGB images are not supported by the `find_boundaries` function of scikit-image
-        rgb2int = ToInt32()
-        rgb2int.run(ips, imgs, para)
-        # We can now invoke ImagePy's boundary marker function
-        super().run(ips, imgs, para)
+        from . import workspace
+        # The colours identify the regions, so the boundaries are found on the (possibly corrected) RGB image
+        # itself, without converting it to an int32 label image first
+        if para['thin']:
+            boundary = workspace.put('skeleton_image', thin_boundaries(ips.img))
+        else:
+            # Only shown: `CreateSkeleton` works on the image of the boundaries
+            workspace.release(*workspace.dependents('skeleton_image'))
+            boundary = thick_boundaries(ips.img)
+        IPy.show_img([boundary.view(np.uint8) * np.uint8(255)], ips.title + '-boundaries')
 
 
 class CreateSkeleton(Skeleton):
     title = 'Create skeleton'
 
     def run(self, ips, snap, img, para=None):
-        from . import storage
-        im = skeletonize(snap > 0)
-        storage.skeleton_image = im.astype(np.bool)
-        im.dtype = np.uint8
-        im *= 255
-        IPy.show_img([im], '-skeleton')
+        from . import workspace
+        skeleton = workspace.put('skeleton_image', skeletonize(snap > 0))
+        IPy.show_img([skeleton.view(np.uint8) * np.uint8(255)], '-skeleton')
 
 
 class WatershedSegmentation(Simple):
     title = 'Watershed segmentation'
     note = ['8-bit']
+    para = {'h': 2.0}
+    view = [(float, 'h', (0, 1024), 1, 'minima depth', 'pixels')]
 
     def run(self, ips, imgs, para = None):
-        from . import storage
+        from . import workspace
         # Create a distance function whose maxima will serve as watershed basins
-        distance_function = distance_transform_edt(1 - storage.skeleton_image)
+        distance_function = distance_transform_edt(~workspace.get('skeleton_image'))
         # Turn the distance function to a negative distance function for watershed
-        distance_function = np.negative(distance_function)
+        np.negative(distance_function, out=distance_function)
         # Do not yet use watershed as that would result an oversegmented image
         # (each local minima of the distance function would become a catchment basin).
-        # Hence, first execute the extended-minima transform to find the regional minima
-        mask = imextendedmin(distance_function, 2)
-        # The watershed segmentation can now be performed
-        labelled = measure.label(mask)
+        # Hence, first execute the extended-minima transform to find the regional minima, labelled in the same pass
+        labelled = extended_minima_markers(distance_function, para['h'], method='queue')
+        # The watershed segmentation can now be performed. The labels are only shown, so they are not stored.
         segmented = watershed(distance_function, labelled)
+        del distance_function, labelled
+        # Colours from a small table, the image of `skimage.color.label2rgb` would take 8 bytes per channel
+        IPy.show_img([palette[segmented % len(palette)]], '-watershed')
 
-        IPy.show_img([color.label2rgb(segmented)], '-watershed')
 
+class UpdateSegmentation(Simple):
+    """Grain boundaries, skeleton and watershed segmentation of the corrected image in one step.
 
-plgs = [OpenImage, FilterImage, InitialSegmentation, MergeClusters, FindGrainBoundaries, CreateSkeleton, WatershedSegmentation]
+    The first run processes the whole image. After manual corrections (e.g. splitting or merging regions of the
+    merged image by painting), only a window around the edited pixels is processed again, see
+    `IncrementalSegmentation`.
+    """
+    title = 'Update segmentation'
+    note = ['rgb']
+    para = {'h': 2.0}
+    view = [(float, 'h', (0, 1024), 1, 'minima depth', 'pixels')]
+
+    def run(self, ips, imgs, para=None):
+        from . import workspace
+        # The colours identify the regions
+        img = ips.img
+        regions = img[:, :, 0].astype(np.int32) << 16
+        regions |= img[:, :, 1].astype(np.int32) << 8
+        regions |= img[:, :, 2]
+        incremental = workspace.get('incremental') if 'incremental' in workspace else None
+        if incremental is None or incremental.regions.shape != regions.shape or incremental.h != para['h']:
+            incremental = workspace.put('incremental', IncrementalSegmentation(regions, para['h']))
+            workspace.put('corrected', palette[incremental.labels % len(palette)])
+        else:
+            window = incremental.update(regions)
+            if window is not None:
+                # The grains outside the updated window keep their colour
+                corrected = workspace.get('corrected', writable=True)
+                corrected[window] = palette[incremental.labels[window] % len(palette)]
+        print(incremental.n_labels)
+        IPy.show_img([workspace.get('corrected').copy()], ips.title + '-corrected')
+
+
+plgs = [OpenImage, FilterImage, InitialSegmentation, MergeClusters, FindGrainBoundaries, CreateSkeleton, WatershedSegmentation,
+        UpdateSegmentation]
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch segmentation of many images from the command line.
+
+The images are processed in parallel by a pool of worker processes. For each
+image, the label image of the watershed segmentation is saved as a `.npy`
+file and a record is appended to the `manifest.jsonl` file of the output
+directory. Images whose label image already exists are skipped, so an
+interrupted batch can simply be restarted. A failing image is recorded in the
+manifest and does not stop the others.
+
+Example:
+    python batch.py ../data -o results -p parameters.json -j 8
+"""
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import os.path as path
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+from grain_statistics import StatisticsWriter, grain_statistics
+from pipeline import WORKFLOW, Pipeline
+
+
+# Parameters of the GrainSegmentation methods, overridden by the parameter file
+DEFAULT_PARAMETERS = {step: defaults for step, (_, defaults) in WORKFLOW.items()}
+
+IMAGE_EXTENSIONS = ['png', 'bmp', 'tif', 'tiff', 'npy']
+
+# Environment variables limiting the threads of the numerical libraries
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def find_images(inputs):
+    """List the images given by directories, glob patterns or file names.
+
+    Parameters
+    ----------
+    inputs : list of str
+        Directories (all the images in them are used), glob patterns or files.
+
+    Returns
+    -------
+    list of str
+        Sorted paths of the images, without duplicates.
+    """
+
+    images = set()
+    for item in inputs:
+        if path.isdir(item):
+            candidates = [path.join(item, name) for name in os.listdir(item)]
+        else:
+            candidates = glob.glob(item)
+        images.update(c for c in candidates
+                      if path.isfile(c) and path.splitext(c)[1][1:].lower() in IMAGE_EXTENSIONS)
+    return sorted(images)
+
+
+def load_parameters(parameter_file=None):
+    """Parameters of the pipeline, completed with the default values.
+
+    Parameters
+    ----------
+    parameter_file : str, optional
+        JSON file mapping the names of the GrainSegmentation methods to their
+        keyword arguments, e.g. {"merge_clusters": {"threshold": 7}}.
+
+    Returns
+    -------
+    dict
+        Keyword arguments for each step of the pipeline.
+    """
+
+    parameters = {step: dict(kwargs) for step, kwargs in DEFAULT_PARAMETERS.items()}
+    if parameter_file is not None:
+        with open(parameter_file) as f:
+            user_parameters = json.load(f)
+        for step, kwargs in user_parameters.items():
+            if step not in parameters:
+                raise Exception('Unknown step {0} in the parameter file. Choose from: '
+                                '{1}.'.format(step, list(parameters)))
+            parameters[step].update(kwargs)
+    return parameters
+
+
+def output_path(image_path, output_directory):
+    """Location of the label image belonging to an image.
+
+    Only the name of the image without its extension is used, so images with
+    the same name must not share an output directory (see `run_batch`).
+    """
+    name = path.splitext(path.basename(image_path))[0]
+    return path.join(output_directory, name + '_labels.npy')
+
+
+def run_pipeline(segmenter, parameters):
+    """Run all the steps of the segmentation on the image of `segmenter`.
+
+    Returns
+    -------
+    ndarray
+        Label image, output of the watershed segmentation.
+    """
+
+    return Pipeline(segmenter, parameters).result('watershed_segmentation')
+
+
+def process_image(image_path, label_path, parameters, mmap=False, cache=None, profile=False, pixel_size=None):
+    """Segment one image and save its label image. Runs in a worker process.
+
+    `cache` is None or the (directory, maximum size in bytes) of a `DiskCache`.
+    With `profile`, the measurements of the steps are added to the record
+    (see `instrumentation.Profiler`), without tracing the memory allocations.
+    When `pixel_size` is given, the grain statistics are returned in the
+    'statistics' item of the record (see `grain_statistics.grain_statistics`).
+
+    Returns
+    -------
+    dict
+        Record for the manifest. Errors are reported here instead of being raised.
+    """
+
+    from caching import DiskCache
+    from grain_segmentation import GrainSegmentation
+
+    record = {'image': image_path, 'labels': label_path}
+    start = time.time()
+    try:
+        disk_cache = DiskCache(*cache) if cache is not None else None
+        segmenter = GrainSegmentation(image_path, interactive_mode=False, mmap=mmap, disk_cache=disk_cache,
+                                      profile='time' if profile else False)
+        labels = run_pipeline(segmenter, parameters)
+        # Before the label file is written, as an image with a label file is skipped when resuming
+        if pixel_size is not None:
+            record['statistics'] = segmenter.grain_statistics(labels, pixel_size)
+        # Write to a temporary file first so that an interrupted run leaves no partial output
+        temporary_path = label_path + '.part'
+        with open(temporary_path, 'wb') as f:
+            np.save(f, labels)
+        os.replace(temporary_path, label_path)
+        record.update(status='done', n_grains=int(np.amax(labels)))
+        if disk_cache is not None:
+            record.update(cache_hits=disk_cache.hits, cache_misses=disk_cache.misses)
+        if profile:
+            record['profile'] = segmenter.profiler.summary()
+    except Exception:
+        record.update(status='failed', error=traceback.format_exc())
+    record['seconds'] = round(time.time() - start, 3)
+    return record
+
+
+def limit_threads(n_threads):
+    """Limit the threads of the numerical libraries in the current process."""
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return  # the environment variables set before starting the workers still apply
+    threadpool_limits(n_threads)
+
+
+@contextmanager
+def worker_environment(n_threads):
+    """Set the thread limits in the environment while worker processes are started.
+
+    The workers inherit the environment, so the limits are applied when their
+    libraries load. The previous values are restored on exit, so that the
+    calling process is not limited afterwards.
+    """
+
+    saved = {variable: os.environ.get(variable) for variable in THREAD_VARIABLES}
+    os.environ.update({variable: str(n_threads) for variable in THREAD_VARIABLES})
+    try:
+        yield
+    finally:
+        for variable, value in saved.items():
+            if value is None:
+                os.environ.pop(variable, None)
+            else:
+                os.environ[variable] = value
+
+
+def run_batch(images, output_directory, parameters, workers=None, threads=1, overwrite=False,
+              mmap=False, cache=None, profile=False, statistics=None, pixel_size=1.0):
+    """Segment images in parallel.
+
+    Parameters
+    ----------
+    images : list of str
+        Paths to the images.
+    output_directory : str
+        Directory of the label images and of the manifest.
+    parameters : dict
+        Keyword arguments of the steps, see `load_parameters`.
+    workers : int, optional
+        Number of worker processes. Defaults to the number of CPUs.
+    threads : int, optional
+        Number of threads each worker may use in the numerical libraries.
+    overwrite : bool, optional
+        When False, images whose label image already exists are skipped.
+    mmap : bool, optional
+        Memory-map the images when the file format allows it.
+    cache : tuple, optional
+        Directory and maximum size in bytes of the persistent cache of the
+        step results, see `caching.DiskCache`. No cache is used by default.
+    profile : bool, optional
+        Record the time spent in each step in the manifest.
+    statistics : str, optional
+        CSV or Parquet file the grain statistics of all the images are written
+        to, as the images are finished (see `grain_statistics.StatisticsWriter`).
+        The rows of the previous runs are kept; the statistics of the skipped
+        images missing from the file are computed from their label images.
+    pixel_size : float, optional
+        Side length of a pixel for the grain statistics.
+
+    Returns
+    -------
+    list of dict
+        The manifest records of this run.
+    """
+
+    # Images with the same name (e.g. a.png and a.bmp, or in different directories) would share a label image
+    label_paths = {}
+    for image_path in images:
+        label_paths.setdefault(output_path(image_path, output_directory), []).append(image_path)
+    collisions = [sources for sources in label_paths.values() if len(sources) > 1]
+    if collisions:
+        raise Exception('Images with the same name would overwrite each other\'s label image: {0}. Rename them '
+                        'or process them in separate output directories.'.format(
+                            '; '.join(', '.join(sources) for sources in collisions)))
+    os.makedirs(output_directory, exist_ok=True)
+    manifest_path = path.join(output_directory, 'manifest.jsonl')
+    records = []
+    jobs = []
+    for image_path in images:
+        label_path = output_path(image_path, output_directory)
+        if not overwrite and path.isfile(label_path):
+            records.append({'image': image_path, 'labels': label_path, 'status': 'skipped'})
+        else:
+            jobs.append((image_path, label_path))
+    context = multiprocessing.get_context('spawn')
+    with open(manifest_path, 'a') as manifest, \
+            worker_environment(threads), \
+            (StatisticsWriter(statistics) if statistics else nullcontext()) as writer, \
+            ProcessPoolExecutor(workers, mp_context=context, initializer=limit_threads,
+                                initargs=(threads,)) as executor:
+        futures = {executor.submit(process_image, image_path, label_path, parameters, mmap, cache,
+                                   profile, pixel_size if statistics else None): image_path
+                   for image_path, label_path in jobs}
+        for future in as_completed(futures):
+            try:
+                record = future.result()
+            except Exception as error:  # the worker process itself died
+                record = {'image': futures[future], 'status': 'failed', 'error': repr(error)}
+            table = record.pop('statistics', None)
+            if table is not None:
+                writer.write(table, image=record['image'])
+            records.append(record)
+            manifest.write(json.dumps(record) + '\n')
+            manifest.flush()
+            print('{0}: {1}'.format(record['status'], record['image']))
+        if writer is not None:
+            # Skipped images whose statistics are not in the file yet, e.g. from a run without them
+            for record in records:
+                if record['status'] == 'skipped' and record['image'] not in writer.images:
+                    writer.write(grain_statistics(np.load(record['labels']), pixel_size), image=record['image'])
+    return records
+
+
+def aggregate_profiles(records):
+    """Total wall time of each step over the profiled records of a batch."""
+    totals = {}
+    for record in records:
+        for step, summary in record.get('profile', {}).items():
+            totals[step] = totals.get(step, 0.0) + summary['wall_time']
+    return totals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Segment grain images in parallel.')
+    parser.add_argument('inputs', nargs='+',
+                        help='directories, glob patterns or image files to be segmented')
+    parser.add_argument('-o', '--output', required=True,
+                        help='directory for the label images and the manifest')
+    parser.add_argument('-p', '--parameters', help='JSON file with the parameters of the steps')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('-t', '--threads', type=int, default=1,
+                        help='threads per worker in the numerical libraries (default: 1)')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='process the images that already have a label image')
+    parser.add_argument('--mmap', action='store_true',
+                        help='memory-map the .npy and uncompressed TIFF images')
+    parser.add_argument('--cache', help='directory of the persistent cache of the step results')
+    parser.add_argument('--cache-size', type=float, default=10,
+                        help='maximum size of the cache in GB (default: 10)')
+    parser.add_argument('--profile', action='store_true',
+                        help='record the time spent in each step in the manifest')
+    parser.add_argument('-s', '--statistics',
+                        help='CSV or Parquet file for the grain statistics of all the images')
+    parser.add_argument('--pixel-size', type=float, default=1.0,
+                        help='side length of a pixel for the grain statistics (default: 1)')
+    args = parser.parse_args(argv)
+
+    images = find_images(args.inputs)
+    if not images:
+        parser.error('no images found')
+    parameters = load_parameters(args.parameters)
+    cache = (args.cache, int(args.cache_size * 2**30)) if args.cache else None
+    records = run_batch(images, args.output, parameters, args.workers, args.threads, args.overwrite,
+                        args.mmap, cache, args.profile, args.statistics, args.pixel_size)
+    statuses = [record['status'] for record in records]
+    print('Done: {0}, skipped: {1}, failed: {2}'.format(
+        statuses.count('done'), statuses.count('skipped'), statuses.count('failed')))
+    if cache is not None:
+        from caching import DiskCache
+        stats = DiskCache(*cache).stats()
+        print('Cache: {0} hits, {1} misses, {2} entries, {3:.1f} MB'.format(
+            sum(record.get('cache_hits', 0) for record in records),
+            sum(record.get('cache_misses', 0) for record in records),
+            stats['entries'], stats['bytes'] / 2**20))
+    if args.profile:
+        print('Time per step:')
+        for step, seconds in aggregate_profiles(records).items():
+            print('  {0}: {1:.2f} s'.format(step, seconds))
+    return 1 if 'failed' in statuses else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Speed and accuracy benchmark of the segmentation on synthetic microstructures.
+
+Grain images with a known segmentation are generated from Voronoi
+tessellations: Poisson-Voronoi (uniformly random seeds) or jittered grid
+(more uniform grain sizes). Every grain gets its own colour, the grain
+boundaries are darker, and the image is blurred and corrupted by noise.
+
+For each image size, the whole workflow of `GrainSegmentation` is run with
+profiling enabled (see `instrumentation.Profiler`), the `gala_light`
+functions are timed on the distance function of the skeleton, and the final
+watershed labels are scored against the ground truth. The results are
+appended as one JSON record per line to a results file, so that runs on
+different versions of the code can be compared:
+
+    python benchmark.py --sizes 512 1024 2048 -o results.jsonl
+    python benchmark.py --compare old.jsonl new.jsonl
+
+With `--factors`, the coarse-to-fine workflow (see
+`GrainSegmentation.coarse_to_fine_segmentation`) is also run with the given
+downsampling factors, and its speed-up and accuracy are printed next to those
+of the full-resolution workflow (factor 1):
+
+    python benchmark.py --sizes 2048 --factors 1 2 4
+
+With `--thin-boundaries`, the grain boundaries are found in one pass (see
+`GrainSegmentation.thin_boundaries`) instead of being thickened and thinned,
+and the agreement of the watershed segmentation with that of the usual
+workflow is recorded.
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+from os import path
+
+import numpy as np
+import scipy
+import skimage
+from scipy.ndimage import distance_transform_edt, gaussian_filter
+from scipy.spatial import cKDTree
+from skimage import segmentation
+
+import gala_light
+from boundaries import agreement
+from grain_segmentation import GrainSegmentation
+from pipeline import COARSE_TO_FINE_WORKFLOW, WORKFLOW, Pipeline, with_thin_boundaries
+
+
+# Colour statistics of the grains of the sample images (RGB)
+GRAIN_COLOR_MEAN = (65, 79, 81)
+GRAIN_COLOR_STD = 18
+BOUNDARY_COLOR = (30, 35, 36)
+
+
+def voronoi_labels(shape, grain_size=40, tessellation='poisson', seed=0, strip_height=1024):
+    """Label image of a random Voronoi tessellation.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Number of rows and columns.
+    grain_size : float, optional
+        Mean grain diameter in pixels.
+    tessellation : {'poisson', 'jittered'}, optional
+        Seeds placed uniformly at random, or one seed randomly placed in each
+        cell of a square grid.
+    seed : int, optional
+        Seed of the random number generator.
+    strip_height : int, optional
+        The nearest seeds are searched for this many rows at a time, which
+        bounds the memory used for large images.
+
+    Returns
+    -------
+    labels : int32 ndarray
+        Labels of the grains, starting from 1.
+    """
+
+    rng = np.random.RandomState(seed)
+    rows, cols = shape
+    if tessellation == 'poisson':
+        n_seeds = max(1, int(round(rows * cols / grain_size ** 2)))
+        seeds = rng.uniform((0, 0), (rows, cols), (n_seeds, 2))
+    elif tessellation == 'jittered':
+        grid = np.mgrid[0:rows:grain_size, 0:cols:grain_size].reshape(2, -1).T
+        seeds = grid + rng.uniform(0, grain_size, grid.shape)
+    else:
+        raise Exception('Unknown tessellation {0}. Choose from: poisson, jittered.'.format(tessellation))
+    tree = cKDTree(seeds)
+    labels = np.empty(shape, dtype=np.int32)
+    col_coordinates = np.arange(cols)
+    for start in range(0, rows, strip_height):
+        stop = min(start + strip_height, rows)
+        points = np.stack(np.broadcast_arrays(np.arange(start, stop)[:, np.newaxis], col_coordinates), -1)
+        _, nearest = tree.query(points.reshape(-1, 2))
+        labels[start:stop] = nearest.reshape(stop - start, cols) + 1
+    return labels
+
+
+def synthetic_microstructure(size, grain_size=40, tessellation='poisson', boundary_width=2,
+                             blur=1.0, noise=8.0, seed=0):
+    """Colour image of grains and its ground truth segmentation.
+
+    Parameters
+    ----------
+    size : int or tuple of int
+        Side length of a square image, or its number of rows and columns.
+    grain_size : float, optional
+        Mean grain diameter in pixels.
+    tessellation : {'poisson', 'jittered'}, optional
+        See `voronoi_labels`.
+    boundary_width : {1, 2}, optional
+        Width of the dark grain boundaries in pixels.
+    blur : float, optional
+        Standard deviation of the Gaussian blur.
+    noise : float, optional
+        Standard deviation of the additive Gaussian noise, in grey levels.
+    seed : int, optional
+        Seed of the random number generator.
+
+    Returns
+    -------
+    image : uint8 ndarray
+        RGB image.
+    truth : int32 ndarray
+        Labels of the grains, starting from 1. The boundary pixels belong to
+        their closest grain.
+    """
+
+    shape = (size, size) if np.isscalar(size) else tuple(size)
+    truth = voronoi_labels(shape, grain_size, tessellation, seed)
+    rng = np.random.RandomState(seed + 1)
+    colors = np.clip(rng.normal(GRAIN_COLOR_MEAN, GRAIN_COLOR_STD, (truth.max() + 1, 3)), 0, 255)
+    image = colors[truth].astype(np.float32)
+    boundary = segmentation.find_boundaries(truth, mode='thick' if boundary_width > 1 else 'inner')
+    image[boundary] = BOUNDARY_COLOR
+    for channel in range(3):
+        gaussian_filter(image[:, :, channel], blur, output=image[:, :, channel])
+        image[:, :, channel] += rng.normal(0, noise, shape).astype(np.float32)
+    return np.clip(image, 0, 255).astype(np.uint8), truth
+
+
+def variation_of_information(truth, labels):
+    """Variation of information between two segmentations.
+
+    Returns
+    -------
+    split : float
+        Conditional entropy H(labels | truth), the oversegmentation error.
+    merge : float
+        Conditional entropy H(truth | labels), the undersegmentation error.
+        The variation of information is `split + merge`.
+    """
+
+    truth = np.asarray(truth, dtype=np.int64).ravel()
+    labels = np.asarray(labels, dtype=np.int64).ravel()
+    _, truth = np.unique(truth, return_inverse=True)
+    _, labels = np.unique(labels, return_inverse=True)
+    _, joint = np.unique(truth * (labels.max() + 1) + labels, return_counts=True)
+
+    def entropy(counts):
+        p = counts / truth.size
+        return -np.sum(p * np.log2(p))
+
+    h_joint = entropy(joint)
+    split = h_joint - entropy(np.bincount(truth))
+    merge = h_joint - entropy(np.bincount(labels))
+    return float(split), float(merge)
+
+
+def score(truth, labels):
+    """Accuracy of a label image against the ground truth."""
+    n_true = len(np.unique(truth))
+    n_found = len(np.unique(labels))
+    split, merge = variation_of_information(truth, labels)
+    return {'n_grains_true': n_true, 'n_grains_found': n_found,
+            'grain_count_error': (n_found - n_true) / n_true,
+            'variation_of_information': split + merge, 'vi_split': split, 'vi_merge': merge}
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def time_gala_light(skeleton, h=2):
+    """Time the functions of `gala_light` on the distance function of a skeleton."""
+    distance_function = np.negative(distance_transform_edt(~skeleton))
+    suppressed = gala_light.hminima(distance_function, h, method='queue')
+    times = {}
+    for method in ('iterative', 'queue'):
+        # Reconstruction by dilation of the distance map lowered by h, as in the h-maxima transform
+        cases = [('morphological_reconstruction', gala_light.morphological_reconstruction,
+                  (-distance_function - h, -distance_function)),
+                 ('hminima', gala_light.hminima, (distance_function, h)),
+                 ('regional_minima', gala_light.regional_minima, (suppressed,)),
+                 ('imextendedmin', gala_light.imextendedmin, (distance_function, h))]
+        for name, function, args in cases:
+            times['{0}[{1}]'.format(name, method)] = timed(function, *args, method=method)[1]
+    return times
+
+
+def coarse_to_fine_parameters(parameters, factor):
+    """Parameters of the coarse-to-fine workflow equivalent to those of the usual workflow."""
+    parameters = dict(parameters or {})
+    coarse = {'factor': factor}
+    if 'threshold' in parameters.get('merge_clusters', {}):
+        coarse['threshold'] = parameters['merge_clusters']['threshold']
+    for step in ('initial_segmentation', 'merge_clusters'):
+        parameters.pop(step, None)
+    parameters['coarse_to_fine_segmentation'] = coarse
+    return parameters
+
+
+def run_case(size, grain_size=40, tessellation='poisson', seed=0, parameters=None, gala=True, factor=1,
+             thin=False):
+    """Segment one synthetic image and collect the measurements.
+
+    With `factor` larger than 1, the coarse-to-fine workflow is run with this
+    downsampling factor instead of the usual workflow. With `thin`, the
+    boundaries are found by `thin_boundaries`, and the 'boundary_agreement'
+    with the skeleton of the thick boundaries is recorded (see
+    `boundaries.agreement`).
+
+    Returns
+    -------
+    dict
+        The parameters of the case, the time of generating the image, the
+        profile of every step, the times of the `gala_light` functions and
+        the accuracy scores.
+    """
+
+    (image, truth), generation_time = timed(synthetic_microstructure, size, grain_size, tessellation,
+                                            seed=seed)
+    # Tracing the memory allocations would distort the times, the RSS is still recorded
+    segmenter = GrainSegmentation.from_array(image, profile='time')
+    if factor > 1:
+        parameters, workflow = coarse_to_fine_parameters(parameters, factor), COARSE_TO_FINE_WORKFLOW
+    else:
+        workflow = WORKFLOW
+    skeleton_step = 'create_skeleton'
+    if thin:
+        parameters = {step: kwargs for step, kwargs in (parameters or {}).items()
+                      if step not in ('find_grain_boundaries', 'create_skeleton')}
+        workflow, skeleton_step = with_thin_boundaries(workflow), 'thin_boundaries'
+    pipeline = Pipeline(segmenter, parameters, workflow)
+    labels = pipeline.result('watershed_segmentation')
+    record = {'size': size, 'grain_size': grain_size, 'tessellation': tessellation, 'seed': seed, 'factor': factor,
+              'thin_boundaries': thin, 'generation_time': generation_time, 'steps': segmenter.profiler.report(),
+              'total_time': sum(r.wall_time for r in segmenter.profiler.records)}
+    if thin:
+        # The usual boundaries of the same merged labels, by an object that does not profile
+        checker = GrainSegmentation.from_array(image)
+        merged = pipeline.result(workflow['thin_boundaries'][0][0])
+        reference = checker.watershed_segmentation(checker.create_skeleton(checker.find_grain_boundaries(merged)))
+        record['boundary_agreement'] = agreement(reference, labels)
+    if gala:
+        record['gala_light'] = time_gala_light(pipeline.result(skeleton_step))
+    record.update(score(truth, labels))
+    return record
+
+
+def environment():
+    """Description of the code and the machine the benchmark runs on."""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=path.dirname(path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'scipy': scipy.__version__, 'skimage': skimage.__version__,
+            'machine': platform.machine(), 'processor': platform.processor()}
+
+
+def load_results(file):
+    """Records of a results file, keyed by (size, grain size, tessellation, seed, factor, thin boundaries)."""
+    records = {}
+    with open(file) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                key = (record['size'], record['grain_size'], record['tessellation'], record['seed'],
+                       record.get('factor', 1), record.get('thin_boundaries', False))
+                records[key] = record
+    return records
+
+
+def compare(old_file, new_file):
+    """Print the change of run time and accuracy between two results files.
+
+    When a case was run several times, the last run of each file is used.
+    """
+
+    old, new = load_results(old_file), load_results(new_file)
+    print('{0:>6} {1:>24} {2:>10} {3:>10} {4:>8}'.format('size', 'measure', 'old', 'new', 'ratio'))
+    for key in sorted(set(old) & set(new)):
+        old_record, new_record = old[key], new[key]
+        old_steps = {step['step']: step['wall_time'] for step in old_record['steps']}
+        new_steps = {step['step']: step['wall_time'] for step in new_record['steps']}
+        rows = [(name, old_steps[name], new_steps[name]) for name in old_steps if name in new_steps]
+        rows += [(name, old_record[name], new_record[name])
+                 for name in ('total_time', 'variation_of_information', 'grain_count_error')]
+        for name, old_value, new_value in rows:
+            ratio = new_value / old_value if old_value else float('nan')
+            print('{0:>6} {1:>24} {2:>10.4f} {3:>10.4f} {4:>7.2f}x'.format(key[0], name, old_value,
+                                                                           new_value, ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the segmentation on synthetic microstructures.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024, 2048],
+                        help='side lengths of the images, up to 16384 (default: 512 1024 2048)')
+    parser.add_argument('--grain-size', type=float, default=40, help='mean grain diameter in pixels')
+    parser.add_argument('--tessellation', choices=['poisson', 'jittered'], default='poisson')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0], help='seeds of the random images')
+    parser.add_argument('-p', '--parameters', help='JSON file with the parameters of the steps')
+    parser.add_argument('--no-gala', action='store_true', help='do not time the gala_light functions')
+    parser.add_argument('--thin-boundaries', action='store_true',
+                        help='find one-pixel wide boundaries directly instead of thinning thick ones')
+    parser.add_argument('--factors', type=int, nargs='+', default=[1],
+                        help='downsampling factors of the coarse-to-fine workflow, 1 being the usual '
+                             'full-resolution workflow (default: 1)')
+    parser.add_argument('-o', '--output', default='benchmark_results.jsonl',
+                        help='file the results are appended to (default: benchmark_results.jsonl)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two results files instead of running the benchmark')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+    parameters = None
+    if args.parameters:
+        with open(args.parameters) as f:
+            parameters = json.load(f)
+    machine = environment()
+    with open(args.output, 'a') as output:
+        for size in args.sizes:
+            for seed in args.seeds:
+                full_time = None
+                for factor in args.factors:
+                    record = run_case(size, args.grain_size, args.tessellation, seed, parameters,
+                                      not args.no_gala, factor, args.thin_boundaries)
+                    record['environment'] = machine
+                    output.write(json.dumps(record) + '\n')
+                    output.flush()
+                    if factor == 1:
+                        full_time = record['total_time']
+                    speedup = ', {0:.1f}x faster'.format(full_time / record['total_time']) \
+                        if full_time and factor > 1 else ''
+                    check = ', agreement with the skeleton {0:.4f}'.format(record['boundary_agreement']) \
+                        if args.thin_boundaries else ''
+                    print('{0:>6} seed {1} factor {2}: {3:.2f} s{4}, {5} of {6} grains, VI {7:.3f}{8}'.format(
+                        size, seed, factor, record['total_time'], speedup, record['n_grains_found'],
+                        record['n_grains_true'], record['variation_of_information'], check))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
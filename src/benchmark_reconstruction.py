@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the morphological reconstruction engines of gala_light on synthetic
+distance maps of increasing size. Both the run times and the agreement of the
+results are reported for hminima, regional_minima and imextendedmin.
+"""
+
+import time
+
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+from skimage import segmentation
+
+from gala_light import hminima, regional_minima, imextendedmin
+
+
+def synthetic_distance_map(size, grain_size=40, seed=0):
+    """Negative distance function of a random Voronoi boundary network."""
+    rng = np.random.RandomState(seed)
+    n_seeds = max(1, (size // grain_size) ** 2)
+    seeds = np.zeros((size, size), dtype=bool)
+    seeds[rng.randint(0, size, n_seeds), rng.randint(0, size, n_seeds)] = True
+    # Label every pixel with its closest seed to obtain the Voronoi cells
+    _, (rows, cols) = distance_transform_edt(~seeds, return_indices=True)
+    cells = rows * size + cols
+    boundary = segmentation.find_boundaries(cells, mode='inner')
+    return np.negative(distance_transform_edt(~boundary))
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    sizes = [256, 512, 1024, 2048]
+    h = 2
+    print('{0:>6} {1:>16} {2:>10} {3:>10} {4:>8} {5:>6}'.format(
+        'size', 'function', 'iterative', 'queue', 'speedup', 'equal'))
+    for size in sizes:
+        distance_function = synthetic_distance_map(size)
+        suppressed = hminima(distance_function, h, method='queue')
+        cases = [('hminima', hminima, (distance_function, h)),
+                 ('regional_minima', regional_minima, (suppressed,)),
+                 ('imextendedmin', imextendedmin, (distance_function, h))]
+        for name, function, args in cases:
+            iterative, t_iterative = timed(function, *args, method='iterative')
+            queue, t_queue = timed(function, *args, method='queue')
+            print('{0:>6} {1:>16} {2:>9.3f}s {3:>9.3f}s {4:>7.1f}x {5:>6}'.format(
+                size, name, t_iterative, t_queue, t_iterative / t_queue,
+                str(np.array_equal(iterative, queue))))
@@ -0,0 +1,243 @@
+"""
+Caching utilities for the segmentation pipeline.
+
+Cached objects are addressed by the content of the arrays they were computed
+from, so a cache entry can never be returned for a different image.
+"""
+
+import hashlib
+import os
+import os.path as path
+from collections import OrderedDict
+
+import numpy as np
+import scipy
+import skimage
+
+
+# Version of the step results stored by `DiskCache`, part of the keys. Increase
+# it whenever the output of a step changes, so that older entries are not
+# returned. 2: label images in compact uint16/uint32 instead of int64.
+CACHE_FORMAT = 2
+
+
+def array_digest(*items):
+    """Content hash of arrays and plain parameters.
+
+    Parameters
+    ----------
+    *items : ndarray or hashable
+        Arrays are hashed by their shape, dtype and data, other items by their
+        representation.
+
+    Returns
+    -------
+    str
+        Hexadecimal digest.
+    """
+
+    hasher = hashlib.blake2b(digest_size=16)
+    for item in items:
+        if isinstance(item, np.ndarray):
+            hasher.update('{0}{1}'.format(item.shape, item.dtype.str).encode())
+            hasher.update(np.ascontiguousarray(item).data)
+        else:
+            hasher.update(repr(item).encode())
+        hasher.update(b'|')
+    return hasher.hexdigest()
+
+
+class LRUCache:
+    """Bounded in-memory cache with least recently used eviction.
+
+    Attributes
+    ----------
+    max_entries : int
+        Maximum number of entries kept.
+    max_bytes : int
+        Maximum total size of the entries, as reported when they are stored.
+    hits : int
+        Number of successful lookups.
+    misses : int
+        Number of failed lookups.
+    """
+
+    def __init__(self, max_entries=8, max_bytes=512 * 2**20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+        self._nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def nbytes(self):
+        """Total size of the stored entries."""
+        return self._nbytes
+
+    def get(self, key, default=None):
+        """Return the entry stored under `key` and mark it as recently used."""
+        if key not in self._entries:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key][0]
+
+    def put(self, key, value, nbytes=0):
+        """Store an entry, evicting the least recently used ones if needed.
+
+        Entries larger than `max_bytes` are not stored at all.
+        """
+        if key in self._entries:
+            self._nbytes -= self._entries.pop(key)[1]
+        if nbytes > self.max_bytes:
+            return
+        self._entries[key] = (value, nbytes)
+        self._nbytes += nbytes
+        while len(self._entries) > self.max_entries or self._nbytes > self.max_bytes:
+            _, (_, evicted_bytes) = self._entries.popitem(last=False)
+            self._nbytes -= evicted_bytes
+
+    def clear(self):
+        """Remove all entries. The counters are kept."""
+        self._entries.clear()
+        self._nbytes = 0
+
+    def stats(self):
+        """Summary of the cache usage.
+
+        Returns
+        -------
+        dict
+            Number of hits, misses, entries and the stored bytes.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._entries), 'bytes': self._nbytes}
+
+
+class DiskCache:
+    """Persistent cache of step results, stored as compressed `.npz` files.
+
+    An entry is addressed by the content of the input arrays of the step, the
+    name of the step, its parameters, the versions of the numerical libraries
+    and the format version of the results (`CACHE_FORMAT`). When the cache
+    grows beyond its size limit, the least recently used entries are deleted.
+    The cache directory can be shared by several processes.
+
+    Attributes
+    ----------
+    directory : str
+        Directory holding the entries.
+    max_bytes : int
+        Maximum total size of the files in the cache.
+    hits : int
+        Number of entries found by this object.
+    misses : int
+        Number of entries not found by this object.
+    """
+
+    def __init__(self, directory, max_bytes=10 * 2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(step, inputs, parameters):
+        """Address of the result of a step.
+
+        Parameters
+        ----------
+        step : str
+            Name of the step.
+        inputs : sequence of ndarray
+            Arrays the step is computed from.
+        parameters : dict
+            Parameters of the step.
+
+        Returns
+        -------
+        str
+            Hexadecimal digest.
+        """
+
+        versions = (CACHE_FORMAT, np.__version__, scipy.__version__, skimage.__version__)
+        return array_digest(step, versions, sorted(parameters.items()), *inputs)
+
+    def _file(self, key):
+        return path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """Return the array stored under `key`, or None if there is none."""
+        try:
+            with np.load(self._file(key)) as data:
+                result = data['result']
+        except (IOError, KeyError, ValueError):  # missing, or removed or truncated by another process
+            self.misses += 1
+            return None
+        try:
+            os.utime(self._file(key))  # mark as recently used
+        except OSError:
+            pass
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """Store an array, then evict the least recently used entries if needed."""
+        temporary_file = '{0}.{1}.part'.format(self._file(key), os.getpid())
+        with open(temporary_file, 'wb') as f:
+            np.savez_compressed(f, result=result)
+        os.replace(temporary_file, self._file(key))
+        self.evict()
+
+    def _entries(self):
+        """(modification time, size, path) of the entries, oldest first."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                file = path.join(self.directory, name)
+                try:
+                    status = os.stat(file)
+                except OSError:
+                    continue
+                entries.append((status.st_mtime, status.st_size, file))
+        return sorted(entries)
+
+    def evict(self):
+        """Delete the least recently used entries until the size limit is met."""
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, file in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Delete all the entries. The counters are kept."""
+        for _, _, file in self._entries():
+            os.remove(file)
+
+    def stats(self):
+        """Summary of the cache usage.
+
+        Returns
+        -------
+        dict
+            Number of hits and misses of this object, and the number and total
+            size of the entries on disk.
+        """
+        entries = self._entries()
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(entries), 'bytes': sum(size for _, size, _ in entries)}
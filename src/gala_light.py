@@ -29,11 +29,18 @@ WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
 """
 
 
-from numpy import unique, ones, minimum
-from scipy.ndimage import grey_dilation, generate_binary_structure, minimum_filter
+from itertools import product
 
+from numpy import unique, ones, minimum, result_type, zeros, arange, int32, subtract, empty_like, array_equal
+from scipy.ndimage import grey_dilation, generate_binary_structure, minimum_filter, label
+from skimage.morphology import reconstruction
 
-def imextendedmin(image, h, connectivity=1):
+
+# Number of morphological reconstructions and of their dilation passes, for profiling
+reconstruction_statistics = {'calls': 0, 'iterations': 0}
+
+
+def imextendedmin(image, h, connectivity=1, method='iterative'):
     """Extended-minima transform.
     The extended minima transform is the regional minima of the h-minima transform.
     The implementation follows the MATLAB function under the same name.
@@ -49,16 +56,44 @@ def imextendedmin(image, h, connectivity=1):
         element. Elements up to a squared distance of `connectivity` from
         the center are considered neighbors. If connectivity=1, no diagonal
         elements are neighbors.
+    method : {'iterative', 'queue'}, optional
+        Morphological reconstruction engine, see `morphological_reconstruction`.
 
     Returns
     -------
     bool ndarray
         True at places of the extended minima.
     """
-    return regional_minima(imhmin(image, h), connectivity)
+    return regional_minima(imhmin(image, h, method), connectivity, method)
+
 
+def extended_minima_markers(image, h, connectivity=1, method='queue'):
+    """Labelled extended minima, ready to be used as watershed markers.
+
+    Same as `skimage.measure.label(imextendedmin(image, h, connectivity))`,
+    with full connectivity, but the regional minima are found and labelled by
+    `label_regional_minima` without a second morphological reconstruction.
+
+    Parameters
+    ----------
+    image : ndarray
+        The input array.
+    h : float
+        Any local minima shallower than this will be flattened.
+    connectivity : int, optional
+        Neighborhood of the pixels, see `imextendedmin`.
+    method : {'iterative', 'queue'}, optional
+        Morphological reconstruction engine of the h-minima transform.
 
-def hminima(a, thresh):
+    Returns
+    -------
+    int32 ndarray
+        Labels of the extended minima starting from 1, 0 elsewhere.
+    """
+    return label_regional_minima(imhmin(image, h, method), connectivity)
+
+
+def hminima(a, thresh, method='iterative'):
     """Suppress all minima that are shallower than thresh.
 
     Parameters
@@ -67,6 +102,8 @@ def hminima(a, thresh):
         The input array on which to perform hminima.
     thresh : float
         Any local minima shallower than this will be flattened.
+    method : {'iterative', 'queue'}, optional
+        Morphological reconstruction engine, see `morphological_reconstruction`.
 
     Returns
     -------
@@ -75,18 +112,89 @@ def hminima(a, thresh):
     """
     maxval = a.max()
     ainv = maxval-a
-    return maxval - morphological_reconstruction(ainv-thresh, ainv)
+    return maxval - morphological_reconstruction(ainv-thresh, ainv, method=method)
 
 
 imhmin = hminima
 
 
-def morphological_reconstruction(marker, mask, connectivity=1):
+def hminima_inplace(a, thresh, connectivity=1):
+    """Suppress all minima that are shallower than thresh, overwriting the input.
+
+    Same as `hminima` with the iterative reconstruction, but the result is
+    computed in `a` with two scratch arrays of the same type, so that the
+    peak memory is about three times the size of `a`. With a float32 input,
+    this is several times less than what `hminima` needs with float64.
+
+    Parameters
+    ----------
+    a : float ndarray
+        The input array, overwritten by the result.
+    thresh : float
+        Any local minima shallower than this will be flattened.
+    connectivity : int, optional
+        Neighborhood of the dilation, see `imextendedmin`.
+
+    Returns
+    -------
+    a : ndarray
+        The input array with shallow minima suppressed.
+    """
+    reconstruction_statistics['calls'] += 1
+    maxval = a.max()
+    mask = subtract(maxval, a, out=a)
+    marker = mask - a.dtype.type(thresh)
+    buffer = empty_like(a)
+    sel = generate_binary_structure(a.ndim, connectivity)
+    while True:
+        grey_dilation(marker, footprint=sel, output=buffer)
+        minimum(buffer, mask, out=buffer)
+        reconstruction_statistics['iterations'] += 1
+        if array_equal(buffer, marker):
+            break
+        marker, buffer = buffer, marker
+    del buffer
+    return subtract(maxval, marker, out=a)
+
+
+def morphological_reconstruction(marker, mask, connectivity=1, method='iterative'):
     """Perform morphological reconstruction of the marker into the mask.
 
     See the Matlab image processing toolbox documentation for details:
     http://www.mathworks.com/help/toolbox/images/f18-16264.html
+
+    Parameters
+    ----------
+    marker : ndarray
+        The seed image, not greater than `mask` anywhere.
+    mask : ndarray
+        The image limiting the reconstruction.
+    connectivity : int, optional
+        Neighborhood of the dilation, see `imextendedmin`.
+    method : {'iterative', 'queue'}, optional
+        'iterative' repeats full-image dilations until nothing changes, so the
+        number of passes grows with the size of the largest basin.
+        'queue' processes the pixels in a priority order, finalizing each pixel
+        once (Robinson & Whelan, implemented in scikit-image). Both give the
+        same result; 'queue' is much faster on large images.
+
+    Returns
+    -------
+    ndarray
+        The reconstructed image.
     """
+    reconstruction_statistics['calls'] += 1
+    if method == 'iterative':
+        return _reconstruction_iterative(marker, mask, connectivity)
+    elif method == 'queue':
+        return _reconstruction_queue(marker, mask, connectivity)
+    else:
+        raise Exception('Unknown reconstruction method {0}. Choose from: '
+                        '{1}.'.format(method, ['iterative', 'queue']))
+
+
+def _reconstruction_iterative(marker, mask, connectivity):
+    """Reconstruction by repeated dilations of the whole image."""
     sel = generate_binary_structure(marker.ndim, connectivity)
     diff = True
     while diff:
@@ -94,10 +202,19 @@ def morphological_reconstruction(marker, mask, connectivity=1):
         markernew = minimum(markernew, mask)
         diff = (markernew-marker).max() > 0
         marker = markernew
+        reconstruction_statistics['iterations'] += 1
     return marker
 
 
-def regional_minima(a, connectivity=1):
+def _reconstruction_queue(marker, mask, connectivity):
+    """Reconstruction visiting each pixel once, in the order of their values."""
+    sel = generate_binary_structure(marker.ndim, connectivity)
+    # Positional arguments: the footprint keyword was renamed between scikit-image versions
+    reconstructed = reconstruction(marker, mask, 'dilation', sel)
+    return reconstructed.astype(result_type(marker, mask), copy=False)
+
+
+def regional_minima(a, connectivity=1, method='iterative'):
     """Find the regional minima in an ndarray.
     As written in the MATLAB documentation of the imregionalmin function:
     "Regional minima are connected components of pixels with a constant
@@ -107,7 +224,60 @@ def regional_minima(a, connectivity=1):
     delta = (values - minimum_filter(values, footprint=ones(3)))[1:].min()
     marker = complement(a)
     mask = marker+delta
-    return marker == morphological_reconstruction(marker, mask, connectivity)
+    return marker == morphological_reconstruction(marker, mask, connectivity, method)
+
+
+def label_regional_minima(a, connectivity=1, label_connectivity=None):
+    """Find and label the regional minima in an ndarray.
+
+    Gives the same minima as `regional_minima`, without sorting the values and
+    without morphological reconstruction. The pixels without a strictly lower
+    neighbour are labelled, which splits them into plateaus of constant value.
+    A plateau is a regional minimum unless it touches a pixel of the same value
+    that has a lower neighbour.
+
+    Parameters
+    ----------
+    a : ndarray
+        The input array.
+    connectivity : int, optional
+        Neighborhood of the pixels, see `imextendedmin`.
+    label_connectivity : int, optional
+        Neighborhood used to label the minima. By default, full connectivity
+        as in `skimage.measure.label(regional_minima(a, connectivity))`, so
+        minima touching only diagonally get the same label. With
+        `connectivity`, each label is a single regional minimum.
+
+    Returns
+    -------
+    int32 ndarray
+        Labels of the regional minima starting from 1, 0 elsewhere.
+    """
+    sel = generate_binary_structure(a.ndim, connectivity)
+    # Outside the array, the border values are repeated, which are never lower
+    candidate = a == minimum_filter(a, footprint=sel, mode='nearest')
+    labels = zeros(a.shape, dtype=int32)
+    n_labels = label(candidate, structure=sel, output=labels)
+    invalid = zeros(n_labels + 1, dtype=bool)
+    for offset in product((-1, 0, 1), repeat=a.ndim):
+        # Each pair of neighbours is visited once, through the offsets after the centre
+        if not sel[tuple(o + 1 for o in offset)] or offset <= (0,) * a.ndim:
+            continue
+        first = tuple(slice(max(-o, 0), n - max(o, 0)) for o, n in zip(offset, a.shape))
+        second = tuple(slice(max(o, 0), n - max(-o, 0)) for o, n in zip(offset, a.shape))
+        same = a[first] == a[second]
+        invalid[labels[second][same & candidate[second] & ~candidate[first]]] = True
+        invalid[labels[first][same & candidate[first] & ~candidate[second]]] = True
+    invalid[0] = True
+    if label_connectivity is None:
+        label_connectivity = a.ndim
+    if label_connectivity == connectivity:
+        lut = zeros(n_labels + 1, dtype=int32)
+        lut[~invalid] = arange(1, n_labels + 1 - invalid.sum() + 1, dtype=int32)
+        return lut[labels]
+    # The plateaus touching through the extra neighbours are joined
+    label(~invalid[labels], structure=generate_binary_structure(a.ndim, label_connectivity), output=labels)
+    return labels
 
 
 def complement(a):
@@ -4,15 +4,46 @@ segmentation of grain-based materials (rocks, metals, etc.)
 """
 
 import os.path as path
+from functools import wraps
 
 import numpy as np
-import scipy.ndimage as ndi
 from scipy.ndimage.morphology import distance_transform_edt
-from skimage import io, segmentation, color, measure
+from skimage import segmentation, color
 from skimage.future import graph
 from skimage.morphology import skeletonize, watershed
 
-from gala_light import imextendedmin
+from boundaries import thin_boundaries
+from caching import LRUCache, array_digest
+from gala_light import extended_minima_markers, hminima_inplace, label_regional_minima
+from grain_statistics import grain_statistics
+from image_io import open_image
+from instrumentation import Profiler
+from labelling import compact_labels, label_dtype
+from median_filter import median_filter
+from preview import Previewer
+from rendering import average_colors
+from tiling import quickshift_tiled
+from merge_tree import MergeTree
+from minima_tree import MinimaTree
+from multiresolution import block_mean, refine_labels
+
+
+def _profiled(method):
+    """Measure a step of the segmentation when profiling is enabled."""
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self.profiler.enabled:
+            return method(self, *args, **kwargs)
+        inputs = [value for key, value in list(enumerate(args)) + list(kwargs.items())
+                  if isinstance(value, np.ndarray) and key != 'out']
+        with self.profiler.measure(method.__name__, inputs or [self.original_image]) as record:
+            result = method(self, *args, **kwargs)
+            if isinstance(result, np.ndarray):
+                record.set_output(result)
+        return result
+
+    return wrapper
 
 
 class GrainSegmentation:
@@ -24,9 +55,25 @@ class GrainSegmentation:
         Matrix representing the initial, unprocessed image.
     save_location : str
         Directory where the processed images are saved
+    rag_cache : LRUCache
+        Merge trees of the Region Adjacency Graphs built so far, addressed by
+        the content of the images they were computed from.
+    minima_cache : LRUCache
+        Minima trees of the distance functions built by
+        `watershed_segmentation`. They hold image-sized arrays, so they are
+        kept apart from `rag_cache` and do not evict the merge trees. By
+        default, at most 2 trees and 1 GB are held; a larger tree is not
+        cached.
+    disk_cache : DiskCache or None
+        Persistent cache of the results of the steps.
+    profiler : Profiler
+        Run time and memory measurements of the steps, when profiling is enabled.
+    previewer : Previewer or None
+        Shows the intermediate results in interactive mode.
     """
 
-    def __init__(self, image_location, save_location=None, interactive_mode=True):
+    def __init__(self, image_location, save_location=None, interactive_mode=True, rag_cache=None,
+                 mmap=False, disk_cache=None, profile=False):
         """Initialize the class with file paths and with some options
 
         Parameters
@@ -36,10 +83,31 @@ class GrainSegmentation:
         save_location : str, optional
             Path to directory where images will be outputted. If not given, the
             same directory is used where the input image is loaded from.
-        show_plots : bool, optional
-            When True, images of each image manipulation step are plotted and
-            details are shown in the console.
-            Default is False.
+        interactive_mode : bool or {'window', 'files', 'blocking'}, optional
+            When not False, downsampled previews of each image manipulation
+            step are shown and details are printed in the console. True is the
+            same as 'window': the previews open in windows while the
+            computation continues. With 'files', the previews are saved as PNG
+            files in `save_location` instead. With 'blocking', the computation
+            waits until each preview window is closed. See `preview.Previewer`.
+        rag_cache : LRUCache, optional
+            Cache for the Region Adjacency Graphs. Pass the same cache to several
+            objects to share it. If not given, a cache holding at most 8 graphs
+            and 512 MB is created.
+        mmap : bool, optional
+            When True, `.npy` and uncompressed TIFF images are memory-mapped
+            read-only instead of being read into memory.
+        disk_cache : DiskCache, optional
+            Persistent cache of the results of the steps. When a step is called
+            with the same inputs and parameters as in an earlier run (possibly
+            in another process), its result is read from the cache. The grain
+            boundaries are cheaper to compute than to look up, so they are not
+            cached.
+        profile : bool or 'time', optional
+            When True, the run time and memory use of each step is recorded in
+            `profiler`. Tracing the memory allocations slows down code creating
+            many Python objects (e.g. the RAG construction), with 'time' only
+            the times, the array sizes and the process-level memory are recorded.
 
         Returns
         -------
@@ -50,28 +118,85 @@ class GrainSegmentation:
         if not path.isfile(image_location):
             raise Exception('Image file {0} does not exist'.format(image_location))
         extension = path.splitext(image_location)[1][1:]
-        allowed_extensions = ['png', 'bmp', 'tiff']
+        allowed_extensions = ['png', 'bmp', 'tif', 'tiff', 'npy']
         if extension.lower() not in allowed_extensions:
             raise Exception('Unsupported image file type {0}. Choose from one of the following \
              image types: {1}.'.format(extension, allowed_extensions))
         self.image_location = image_location
         if save_location is None:
-            self.save_location = path.dirname(image_location)
-        else:
-            self.save_location = save_location
-        self.__interactive_mode = interactive_mode
-        self.__stored_graph = None
+            save_location = path.dirname(image_location)
         # Load the image and optionally show it
-        self.original_image = io.imread(image_location)
+        self.__setup(open_image(image_location, mmap), save_location, interactive_mode, rag_cache,
+                     disk_cache, profile)
+
+    @classmethod
+    def from_array(cls, image, save_location=None, interactive_mode=False, rag_cache=None,
+                   disk_cache=None, profile=False):
+        """Initialize the class with an image already in memory.
+
+        Parameters
+        ----------
+        image : ndarray
+            The image to be segmented.
+        save_location : str, optional
+            Path to directory where images will be outputted.
+        interactive_mode : bool or {'window', 'files', 'blocking'}, optional
+            Show previews of each step, see `__init__`.
+        rag_cache : LRUCache, optional
+            Cache for the Region Adjacency Graphs, see `__init__`.
+        disk_cache : DiskCache, optional
+            Persistent cache of the results of the steps, see `__init__`.
+        profile : bool, optional
+            Record the run time and memory use of the steps, see `__init__`.
+
+        Returns
+        -------
+        GrainSegmentation
+            The initialized object.
+        """
+
+        segmenter = cls.__new__(cls)
+        segmenter.image_location = None
+        segmenter.__setup(image, save_location, interactive_mode, rag_cache, disk_cache, profile)
+        return segmenter
+
+    def __setup(self, image, save_location, interactive_mode, rag_cache, disk_cache, profile):
+        """Set the attributes shared by all the ways of initialization."""
+        self.save_location = save_location
+        self.__interactive_mode = bool(interactive_mode)
+        self.previewer = None
+        if interactive_mode:
+            mode = 'window' if interactive_mode is True else interactive_mode
+            self.previewer = Previewer(mode, save_location)
+        if rag_cache is None:
+            rag_cache = LRUCache(max_entries=8, max_bytes=512 * 2**20)
+        self.rag_cache = rag_cache
+        self.minima_cache = LRUCache(max_entries=2, max_bytes=2**30)
+        self.disk_cache = disk_cache
+        self.profiler = Profiler(enabled=bool(profile), trace_memory=profile != 'time')
+        self.original_image = image
         if self.__interactive_mode:
-            io.imshow(self.original_image)
-            io.show()
+            self.previewer.show('original_image', _as_is, self.original_image)
             print('Image successfully loaded.')
 
-    def filter_image(self, window_size, image_matrix=None):
+    @property
+    def original_image(self):
+        """Matrix representing the initial, unprocessed image."""
+        return self.__original_image
+
+    @original_image.setter
+    def original_image(self, image):
+        # The cached results are addressed by the digest of the image, computed again for a new one
+        self.__original_image = image
+        self.__image_digest = None
+
+    @_profiled
+    def filter_image(self, window_size, image_matrix=None, out=None, workers=None):
         """Median filtering on an image.
         The median filter is useful in our case as it preserves the important
-        borders (i.e. the grain boundaries).
+        borders (i.e. the grain boundaries). Each colour channel is filtered
+        separately with a square window, using a sliding histogram for 8-bit
+        images (see `median_filter.median_filter`).
 
         Parameters
         ----------
@@ -79,6 +204,11 @@ class GrainSegmentation:
             Size of the sampling window.
         image_matrix : 3D ndarray with size 3 in the third dimension, optional
             Input image to be filtered. If not given, the original image is used.
+        out : ndarray, optional
+            Array of the shape of the image to write the result into, e.g. a
+            memory-mapped file created by `image_io.open_output`.
+        workers : int, optional
+            Number of threads. Defaults to the number of CPUs.
 
         Returns
         -------
@@ -95,44 +225,68 @@ class GrainSegmentation:
                 raise Exception('3D ndarray with size 3 in the third dimension expected.')
             else:
                 image = image_matrix
-        filtered_image = ndi.median_filter(image, window_size)
+        filtered_image = self.__cached('filter_image', [image], {'window_size': window_size},
+                                       lambda: median_filter(image, window_size, out, workers), out)
         if self.__interactive_mode:
-            io.imshow(filtered_image)
-            io.show()
+            self.previewer.show('filter_image', _as_is, filtered_image)
             print('Median filtering finished.')
         return filtered_image
 
-    def initial_segmentation(self, *args):
+    @_profiled
+    def initial_segmentation(self, *args, out=None, workers=1, tile_size=512, overlap=32):
         """Perform the quick shift superpixel segmentation on an image.
         The quick shift algorithm is invoked with its default parameters.
+        With several workers, overlapping tiles are segmented in parallel and
+        their superpixels are stitched together (see `tiling.quickshift_tiled`).
 
         Parameters
         ----------
         *args : 3D numpy array with size 3 in the third dimension
             Input image to be segmented. If not given, the original image is used.
+        out : int ndarray, optional
+            Array to copy the result into, see `filter_image`.
+        workers : int, optional
+            Number of threads. With 1 (default), the whole image is segmented at once.
+        tile_size : int, optional
+            Size of the tiles when `workers` is more than 1.
+        overlap : int, optional
+            Overlap between the tiles when `workers` is more than 1.
 
         Returns
         -------
         segment_mask : ndarray
-            Label image, output of the quick shift algorithm.
+            Label image, output of the quick shift algorithm, in the smallest
+            sufficient unsigned type (see `labelling.compact_labels`).
         """
 
         if args:
             image = args[0]
         else:
             image = self.original_image
-        segment_mask = segmentation.quickshift(image)
+
+        def compute():
+            if workers > 1:
+                return _store(compact_labels(quickshift_tiled(image, tile_size, overlap, workers)), out)
+            return _store(compact_labels(segmentation.quickshift(image)), out)
+
+        parameters = {'workers': workers, 'tile_size': tile_size, 'overlap': overlap}
+        segment_mask = self.__cached('initial_segmentation', [image], parameters, compute, out)
         if self.__interactive_mode:
-            io.imshow(color.label2rgb(segment_mask, self.original_image, kind='avg'))
-            io.show()
+            self.previewer.show('initial_segmentation', average_colors, segment_mask, self.original_image)
             print('Quick shift segmentation finished. '
                   'Number of segments: {0}'.format(np.amax(segment_mask)))
         return segment_mask
 
-    def merge_clusters(self, segmented_image, threshold=5):
+    @_profiled
+    def merge_clusters(self, segmented_image, threshold=5, connectivity=2, mode='distance', sigma=255.0,
+                       out=None):
         """Merge tiny superpixel clusters.
         Superpixel segmentations result in oversegmented images. Based on graph
         theoretic tools, similar clusters are merged.
+        The edges of the Region Adjacency Graph (RAG) are sorted into a merge
+        tree, which is cached for the given label image and graph parameters.
+        Trying other thresholds later only costs a lookup table applied on the
+        label image.
 
         Parameters
         ----------
@@ -140,34 +294,100 @@ class GrainSegmentation:
             Label image, output of a segmentation.
         threshold : float, optional
             Regions connected by edges with smaller weights are combined.
+        connectivity : int, optional
+            Pixels with a squared distance less than `connectivity` from each
+            other are considered adjacent when building the RAG.
+        mode : {'distance', 'similarity'}, optional
+            Strategy to assign edge weights, see `graph.rag_mean_color`.
+        sigma : float, optional
+            Used for computation when `mode` is 'similarity'.
+        out : int ndarray, optional
+            Array to write the result into, see `filter_image`.
 
         Returns
         -------
         merged_superpixels : ndarray
-            The new labelled array.
+            The new labelled array, with consecutive labels from 0 in uint16
+            or uint32.
         """
 
-        if self.__stored_graph is None:
-            # Region Adjacency Graph (RAG) not yet determined -> compute it
-            g = graph.rag_mean_color(self.original_image, segmented_image)
-            self.__stored_graph = g
-        else:
-            g = self.__stored_graph
-        merged_superpixels = graph.cut_threshold(segmented_image, g, threshold, in_place=False)
+        def compute():
+            key = array_digest(segmented_image, self.__original_digest(), connectivity, mode, sigma)
+            tree = self.rag_cache.get(key)
+            if tree is None:
+                # Region Adjacency Graph (RAG) not yet determined -> compute it
+                g = graph.rag_mean_color(self.original_image, segmented_image, connectivity, mode, sigma)
+                tree = MergeTree(g)
+                self.rag_cache.put(key, tree, tree.nbytes)
+            return tree.cut(segmented_image, threshold, out, label_dtype(tree.n_labels))
+
+        parameters = {'threshold': threshold, 'connectivity': connectivity, 'mode': mode, 'sigma': sigma}
+        merged_superpixels = self.__cached('merge_clusters', [segmented_image, self.original_image],
+                                           parameters, compute, out)
         if self.__interactive_mode:
-            io.imshow(color.label2rgb(merged_superpixels, self.original_image, kind='avg'))
-            io.show()
+            self.previewer.show('merge_clusters', average_colors, merged_superpixels, self.original_image)
             print('Tiny clusters merged. '
                   'Number of segments: {0}'.format(np.amax(merged_superpixels)))
         return merged_superpixels
 
-    def find_grain_boundaries(self, segmented_image):
+    @_profiled
+    def coarse_to_fine_segmentation(self, filtered_image, factor=2, threshold=5, margin=1, out=None):
+        """Quick shift segmentation and merging of the clusters at a lower resolution.
+        The images are downsampled by `factor`, segmented with
+        `initial_segmentation` and `merge_clusters`, and the merged labels are
+        upsampled. The boundaries are then refined at full resolution, in a band
+        around them only (see `multiresolution.refine_labels`). The result
+        replaces that of `merge_clusters` in the workflow, at a fraction of the
+        cost for large images.
+
+        Parameters
+        ----------
+        filtered_image : 3D numpy array with size 3 in the third dimension
+            Output of `filter_image`.
+        factor : int, optional
+            Downsampling factor. The grains should stay several times larger
+            than `factor` pixels.
+        threshold : float, optional
+            Threshold of `merge_clusters`.
+        margin : int, optional
+            Half width of the refined band around the boundaries, in pixels of
+            the downsampled image.
+        out : int ndarray, optional
+            Array to write the result into, see `filter_image`.
+
+        Returns
+        -------
+        merged_superpixels : ndarray
+            Label image of the size of the original image, in uint16 or uint32.
+        """
+
+        def compute():
+            coarse = GrainSegmentation.from_array(block_mean(self.original_image, factor),
+                                                  rag_cache=self.rag_cache)
+            segmented = coarse.initial_segmentation(block_mean(filtered_image, factor))
+            merged = coarse.merge_clusters(segmented, threshold)
+            return _store(compact_labels(refine_labels(merged, filtered_image, factor, margin)), out)
+
+        parameters = {'factor': factor, 'threshold': threshold, 'margin': margin}
+        merged_superpixels = self.__cached('coarse_to_fine_segmentation', [filtered_image, self.original_image],
+                                           parameters, compute, out)
+        if self.__interactive_mode:
+            self.previewer.show('coarse_to_fine_segmentation', average_colors, merged_superpixels,
+                                self.original_image)
+            print('Coarse-to-fine segmentation finished. '
+                  'Number of segments: {0}'.format(np.amax(merged_superpixels)))
+        return merged_superpixels
+
+    @_profiled
+    def find_grain_boundaries(self, segmented_image, out=None):
         """Find the grain boundaries.
 
         Parameters
         ----------
         segmented_image : ndarray
             Label image, output of a segmentation.
+        out : bool ndarray, optional
+            Array to copy the result into, see `filter_image`.
 
         Returns
         -------
@@ -175,23 +395,25 @@ class GrainSegmentation:
             A bool ndarray, where True represents a boundary pixel.
         """
 
-        boundary = segmentation.find_boundaries(segmented_image)
+        boundary = _store(segmentation.find_boundaries(segmented_image), out)
         if self.__interactive_mode:
             # Superimpose the boundaries of the segmented image on the original image
-            superimposed = segmentation.mark_boundaries(self.original_image,
-                                                        segmented_image, mode='thick')
-            io.imshow(superimposed)
-            io.show()
+            self.previewer.show('find_grain_boundaries',
+                                lambda image, labels: segmentation.mark_boundaries(image, labels, mode='thick'),
+                                self.original_image, segmented_image)
             print('Grain boundaries found.')
         return boundary
 
-    def create_skeleton(self, boundary_image):
+    @_profiled
+    def create_skeleton(self, boundary_image, out=None):
         """Use thinning on the grain boundary image to obtain a single-pixel wide skeleton.
 
         Parameters
         ----------
         boundary_image : bool ndarray
             A binary image containing the objects to be skeletonized.
+        out : bool ndarray, optional
+            Array to copy the result into, see `filter_image`.
 
         Returns
         -------
@@ -199,14 +421,44 @@ class GrainSegmentation:
             Thinned image.
         """
 
-        skeleton = skeletonize(boundary_image)
+        skeleton = self.__cached('create_skeleton', [boundary_image], {},
+                                 lambda: _store(skeletonize(boundary_image), out), out)
         if self.__interactive_mode:
-            io.imshow(skeleton)
-            io.show()
+            self.previewer.show('create_skeleton', _as_is, skeleton)
             print('Skeleton constructed.')
         return skeleton
 
-    def watershed_segmentation(self, skeleton):
+    @_profiled
+    def thin_boundaries(self, segmented_image, out=None):
+        """Find one-pixel wide grain boundaries directly.
+        Replaces `find_grain_boundaries` followed by `create_skeleton`: only
+        the top or left pixel of each pair of neighbours with different labels
+        is marked (see `boundaries.thin_boundaries`), in one pass and without
+        iterative thinning. The boundaries lie half a pixel off those of the
+        skeleton, so the watershed segmentation gives the same grains up to
+        the pixels along the boundaries.
+
+        Parameters
+        ----------
+        segmented_image : ndarray
+            Label image, output of a segmentation.
+        out : bool ndarray, optional
+            Array to copy the result into, see `filter_image`.
+
+        Returns
+        -------
+        skeleton : bool ndarray
+            The boundary network, input of `watershed_segmentation`.
+        """
+
+        skeleton = thin_boundaries(segmented_image, out)
+        if self.__interactive_mode:
+            self.previewer.show('thin_boundaries', _as_is, skeleton)
+            print('Thin grain boundaries found.')
+        return skeleton
+
+    @_profiled
+    def watershed_segmentation(self, skeleton, reconstruction_method='queue', low_memory=False, h=2, out=None):
         """Watershed segmentation of a granular microstructure.
         Uses the watershed transform to label non-overlapping grains in a cellular
         microstructure given by the grain boundaries.
@@ -215,28 +467,179 @@ class GrainSegmentation:
         ----------
         skeleton : bool ndarray
             A binary image, the skeletonized grain boundaries.
+        reconstruction_method : {'queue', 'iterative'}, optional
+            Morphological reconstruction engine used by the extended-minima
+            transform. Both give the same result, 'queue' is faster.
+        low_memory : bool, optional
+            When True, the distance function is computed in float32 and the
+            extended-minima transform works in place (see
+            `gala_light.hminima_inplace`), using the iterative reconstruction
+            whatever `reconstruction_method` is. This needs several times less
+            memory, but is slower.
+        h : float or sequence of float, optional
+            Depth of the extended minima: basins of the distance function
+            shallower than `h` are merged with their neighbours. Larger values
+            give fewer grains. For a sequence of values, a minima tree of the
+            distance function (see `minima_tree.MinimaTree`) is built, from
+            which the markers of each value are obtained without a new h-minima
+            transform. The tree is kept in `minima_cache`, so later calls on the
+            same skeleton are fast for any `h`.
+        out : int ndarray, optional
+            Array to copy the result into, see `filter_image`.
 
         Returns
         -------
         segmented : ndarray
-            Label image, output of the watershed segmentation.
+            Label image, output of the watershed segmentation, in uint16 or
+            uint32. For a sequence of `h` values, the label images are stacked
+            along the first axis.
         """
         if skeleton.dtype.name is not 'bool':
             raise Exception('A numpy array of type bool expected.')
-        # Create a distance function whose maxima will serve as watershed basins
-        distance_function = distance_transform_edt(1-skeleton)
-        # Turn the distance function to a negative distance function for watershed
-        distance_function = np.negative(distance_function)
-        # Do not yet use watershed as that would result an oversegmented image
-        # (each local minima of the distance function would become a catchment basin).
-        # Hence, first execute the extended-minima transform to find the regional minima
-        mask = imextendedmin(distance_function, 2)
-        # The watershed segmentation can now be performed
-        labelled = measure.label(mask)
-        segmented = watershed(distance_function, labelled)
+        sweep = np.ndim(h) > 0
+
+        def compute():
+            tree_key = array_digest('minima_tree', skeleton, low_memory)
+            tree = self.minima_cache.get(tree_key)
+            if tree is None and sweep:
+                tree = MinimaTree(_negative_distance(skeleton, low_memory))
+                self.minima_cache.put(tree_key, tree, tree.nbytes)
+            if tree is not None:
+                return _store(compact_labels(np.stack([watershed(tree.image, tree.markers(value))
+                                                       for value in np.ravel(h)])
+                                             if sweep else watershed(tree.image, tree.markers(h))), out)
+            if low_memory:
+                return _store(compact_labels(_watershed_low_memory(skeleton, h)), out)
+            # Create a distance function whose maxima will serve as watershed basins, and
+            # turn it to a negative distance function for watershed
+            distance_function = _negative_distance(skeleton)
+            # Do not yet use watershed as that would result an oversegmented image
+            # (each local minima of the distance function would become a catchment basin).
+            # Hence, first execute the extended-minima transform to find the regional minima,
+            # labelled in the same pass
+            labelled = extended_minima_markers(distance_function, h, method=reconstruction_method)
+            # The watershed segmentation can now be performed
+            return _store(compact_labels(watershed(distance_function, labelled)), out)
+
+        # The reconstruction method does not change the result, so it is not part of the cache key
+        parameters = {'low_memory': low_memory, 'h': tuple(np.ravel(h).tolist()) if sweep else h}
+        segmented = self.__cached('watershed_segmentation', [skeleton], parameters, compute, out)
         if self.__interactive_mode:
-            io.imshow(color.label2rgb(segmented))
-            io.show()
-            print('Watershed segmentation finished. '
-                  'Number of segments: {0}'.format(np.amax(segmented)))
+            for value, labels in zip(np.ravel(h), segmented if sweep else [segmented]):
+                self.previewer.show('watershed_segmentation_h{0:g}'.format(value) if sweep
+                                    else 'watershed_segmentation', color.label2rgb, labels)
+                print('Watershed segmentation finished. '
+                      'Number of segments: {0}'.format(np.amax(labels)))
         return segmented
+
+    @_profiled
+    def grain_statistics(self, segmented, pixel_size=1.0):
+        """Size, shape and neighbourhood of the grains.
+
+        Parameters
+        ----------
+        segmented : int ndarray
+            Label image, output of the watershed segmentation.
+        pixel_size : float, optional
+            Side length of a pixel, in the unit of the reported lengths.
+
+        Returns
+        -------
+        OrderedDict
+            One array per quantity, one row per grain. See
+            `grain_statistics.grain_statistics` for the list of quantities.
+        """
+
+        statistics = grain_statistics(segmented, pixel_size)
+        if self.__interactive_mode:
+            print('Grain statistics computed. Mean equivalent diameter: {0:.4g}'.format(
+                np.mean(statistics['equivalent_diameter'])))
+        return statistics
+
+    def __original_digest(self):
+        """Digest of the original image, computed only once."""
+        if self.__image_digest is None:
+            self.__image_digest = array_digest(self.original_image)
+        return self.__image_digest
+
+    def __cached(self, step, inputs, parameters, compute, out=None):
+        """Result of a step, read from the disk cache if possible.
+
+        Parameters
+        ----------
+        step : str
+            Name of the step.
+        inputs : list of ndarray
+            Arrays the result depends on.
+        parameters : dict
+            Parameters the result depends on.
+        compute : callable
+            Computes the result (into `out`, if given) on a cache miss.
+        out : ndarray, optional
+            Output array of the step.
+
+        Returns
+        -------
+        ndarray
+            Result of the step.
+        """
+
+        if self.disk_cache is None:
+            return compute()
+        inputs = [self.__original_digest() if item is self.original_image else item for item in inputs]
+        key = self.disk_cache.key(step, inputs, parameters)
+        result = self.disk_cache.get(key)
+        if result is None:
+            result = compute()
+            self.disk_cache.put(key, result)
+            return result
+        return _store(result, out)
+
+
+def _distance_map(skeleton, dtype=np.float32, chunk_rows=256):
+    """Euclidean distance of each pixel to the skeleton, with little memory.
+
+    Only the feature transform (two int32 arrays) is computed for the whole
+    image by `distance_transform_edt`, the distances are then evaluated in
+    chunks of rows directly into an array of type `dtype`.
+    """
+
+    indices = distance_transform_edt(~skeleton, return_distances=False, return_indices=True)
+    distance = np.empty(skeleton.shape, dtype=dtype)
+    columns = np.arange(skeleton.shape[1])
+    for start in range(0, skeleton.shape[0], chunk_rows):
+        stop = min(start + chunk_rows, skeleton.shape[0])
+        rows = np.arange(start, stop)[:, np.newaxis]
+        squared = np.square(indices[0, start:stop] - rows, dtype=np.float64)
+        squared += np.square(indices[1, start:stop] - columns, dtype=np.float64)
+        np.sqrt(squared, out=distance[start:stop])
+    return distance
+
+
+def _negative_distance(skeleton, low_memory=False):
+    """Negative distance function of the pixels to the skeleton."""
+    if low_memory:
+        distance_function = _distance_map(skeleton)
+        return np.negative(distance_function, out=distance_function)
+    return np.negative(distance_transform_edt(~skeleton))
+
+
+def _watershed_low_memory(skeleton, h=2):
+    """Watershed segmentation of `GrainSegmentation.watershed_segmentation` in float32, in place."""
+    distance_function = _negative_distance(skeleton, low_memory=True)
+    suppressed = hminima_inplace(distance_function.copy(), h)
+    labelled = label_regional_minima(suppressed)
+    del suppressed
+    return watershed(distance_function, labelled)
+
+
+def _as_is(image):
+    return image
+
+
+def _store(result, out):
+    """Copy the result of a step into the output array, if there is one."""
+    if out is None or result is out:
+        return result
+    out[...] = result
+    return out
@@ -0,0 +1,221 @@
+"""
+Statistics of the grains of a label image.
+
+The quantities are computed for all the grains at once from sums over the
+pixels (`np.bincount`), without looping over the grains:
+ - size: area, equivalent diameter;
+ - shape: major and minor axis lengths of the ellipse with the same second
+   moments, aspect ratio, orientation (the conventions of
+   `skimage.measure.regionprops`);
+ - neighbourhood: number of neighbouring grains and boundary length, from
+   the pairs of adjacent pixels with different labels (the edges of the
+   Region Adjacency Graph).
+
+The tables of many images can be streamed to a CSV or Parquet file with
+`StatisticsWriter`, which only holds the table of the current image.
+"""
+
+import csv
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Columns of the table returned by `grain_statistics`
+COLUMNS = ['label', 'area', 'equivalent_diameter', 'centroid_row', 'centroid_col', 'major_axis_length',
+           'minor_axis_length', 'aspect_ratio', 'orientation', 'n_neighbours', 'boundary_length', 'touches_border']
+
+
+def grain_adjacency(labels):
+    """Pairs of adjacent grains and the length of their common boundary.
+
+    Two pixels are adjacent if they share a side. The length of a boundary is
+    the number of such pixel sides between the two grains.
+
+    Parameters
+    ----------
+    labels : 2D int ndarray
+        Label image. Zero is treated as a grain too.
+
+    Returns
+    -------
+    first, second : int ndarray
+        Labels of the adjacent grains, `first` < `second`.
+    length : int ndarray
+        Length of the common boundary in pixels.
+    """
+
+    pairs = []
+    for a, b in ((labels[:, :-1], labels[:, 1:]), (labels[:-1, :], labels[1:, :])):
+        different = a != b
+        pairs.append(np.stack([a[different], b[different]]).astype(np.int64))
+    pairs = np.concatenate(pairs, axis=1)
+    pairs.sort(axis=0)
+    if pairs.shape[1] == 0:
+        return np.empty(0, np.int64), np.empty(0, np.int64), np.empty(0, np.int64)
+    n = int(pairs.max()) + 1
+    keys, length = np.unique(pairs[0] * n + pairs[1], return_counts=True)
+    first, second = np.divmod(keys, n)
+    return first, second, length
+
+
+def grain_statistics(labels, pixel_size=1.0):
+    """Size, shape and neighbourhood of every grain.
+
+    Parameters
+    ----------
+    labels : 2D int ndarray
+        Label image, e.g. the output of the watershed segmentation. Zero is
+        the background and is not reported.
+    pixel_size : float, optional
+        Side length of a pixel. Lengths are multiplied by it, areas by its square.
+
+    Returns
+    -------
+    OrderedDict
+        One array per column of `COLUMNS`, one row per grain present in the image.
+    """
+
+    labels = np.asarray(labels)
+    flat = labels.ravel().astype(np.intp)
+    n = int(flat.max()) + 1 if flat.size else 1
+    rows, cols = np.indices(labels.shape).reshape(2, -1)
+    area = np.bincount(flat, minlength=n).astype(float)
+    present = np.flatnonzero(area)
+    present = present[present != 0]
+    safe_area = np.maximum(area, 1)
+    # Centroids and central second moments
+    row_mean = np.bincount(flat, rows, n) / safe_area
+    col_mean = np.bincount(flat, cols, n) / safe_area
+    mu_rr = np.bincount(flat, rows.astype(float) ** 2, n) / safe_area - row_mean ** 2
+    mu_cc = np.bincount(flat, cols.astype(float) ** 2, n) / safe_area - col_mean ** 2
+    mu_rc = np.bincount(flat, rows.astype(float) * cols, n) / safe_area - row_mean * col_mean
+    # Eigenvalues of the inertia tensor, as in regionprops
+    half_difference = np.sqrt(((mu_rr - mu_cc) / 2) ** 2 + mu_rc ** 2)
+    largest = (mu_rr + mu_cc) / 2 + half_difference
+    smallest = np.maximum((mu_rr + mu_cc) / 2 - half_difference, 0)
+    major = 4 * np.sqrt(largest)
+    minor = 4 * np.sqrt(smallest)
+    # Angle between the row axis and the major axis, in [-pi/2, pi/2]
+    orientation = np.where(mu_rr == mu_cc, np.where(mu_rc > 0, np.pi / 4, -np.pi / 4),
+                           0.5 * np.arctan2(2 * mu_rc, mu_rr - mu_cc))
+    # Neighbours and boundary lengths from the adjacent pairs; the background is not a neighbour
+    first, second, length = grain_adjacency(labels)
+    n_neighbours = np.bincount(first[first != 0], minlength=n) + np.bincount(second[first != 0], minlength=n)
+    # Boundaries with other grains and with the background both count
+    boundary_length = np.bincount(first, length, n) + np.bincount(second, length, n)
+    border = np.zeros(n, dtype=bool)
+    for edge in (labels[0], labels[-1], labels[:, 0], labels[:, -1]):
+        border[edge] = True
+
+    table = OrderedDict()
+    table['label'] = present
+    table['area'] = area[present] * pixel_size ** 2
+    table['equivalent_diameter'] = np.sqrt(4 * area[present] / np.pi) * pixel_size
+    table['centroid_row'] = row_mean[present] * pixel_size
+    table['centroid_col'] = col_mean[present] * pixel_size
+    table['major_axis_length'] = major[present] * pixel_size
+    table['minor_axis_length'] = minor[present] * pixel_size
+    table['aspect_ratio'] = major[present] / np.maximum(minor[present], np.finfo(float).tiny)
+    table['orientation'] = orientation[present]
+    table['n_neighbours'] = n_neighbours[present]
+    table['boundary_length'] = boundary_length[present] * pixel_size
+    table['touches_border'] = border[present]
+    return table
+
+
+class StatisticsWriter:
+    """Append the statistics tables of images to one CSV or Parquet file.
+
+    Only the table being written is held in memory. Use it as a context manager:
+
+        with StatisticsWriter('grains.csv') as writer:
+            for path, labels in results:
+                writer.write(grain_statistics(labels), image=path)
+
+    The rows of an existing file are kept, so that a resumed batch adds to the
+    statistics of the previous runs. A CSV file is appended to; a Parquet
+    file cannot be, so its row groups are copied into a new file, which
+    replaces it when the writer is closed.
+
+    Attributes
+    ----------
+    path : str
+        The output file.
+    format : {'csv', 'parquet'}
+        File format, deduced from the extension if not given. Parquet needs
+        the pyarrow package.
+    images : set of str
+        The images whose rows were in the file when it was opened.
+    n_rows : int
+        Number of rows written so far.
+    """
+
+    def __init__(self, path, format=None):
+        if format is None:
+            format = 'parquet' if path.lower().endswith('.parquet') else 'csv'
+        if format not in ('csv', 'parquet'):
+            raise Exception('Unknown format {0}. Choose from: csv, parquet.'.format(format))
+        self.path = path
+        self.format = format
+        self.images = set()
+        self.n_rows = 0
+        self._file = None
+        self._writer = None
+        self._exists = os.path.isfile(path) and os.path.getsize(path) > 0
+        if self._exists:
+            if format == 'csv':
+                with open(path, newline='') as f:
+                    self.images = {row['image'] for row in csv.DictReader(f)}
+            else:
+                self.images = set(_parquet().read_table(path, columns=['image']).column('image').to_pylist())
+
+    def write(self, table, image=None):
+        """Append a table, tagging its rows with the image they come from."""
+        columns = OrderedDict([('image', np.full(len(table['label']), '' if image is None else str(image)))])
+        columns.update(table)
+        if self.format == 'csv':
+            if self._writer is None:
+                self._file = open(self.path, 'a', newline='')
+                self._writer = csv.writer(self._file)
+                if not self._exists:
+                    self._writer.writerow(list(columns))
+            self._writer.writerows(zip(*[column.tolist() for column in columns.values()]))
+            self._file.flush()
+        else:
+            import pyarrow
+            parquet = _parquet()
+            batch = pyarrow.table(OrderedDict((name, pyarrow.array(values)) for name, values in columns.items()))
+            if self._writer is None:
+                self._writer = parquet.ParquetWriter(self.path + '.part', batch.schema)
+                if self._exists:
+                    previous = parquet.ParquetFile(self.path)
+                    for group in range(previous.num_row_groups):
+                        self._writer.write_table(previous.read_row_group(group).cast(batch.schema))
+            self._writer.write_table(batch)
+        self.n_rows += len(table['label'])
+
+    def close(self):
+        if self._writer is not None and self.format == 'parquet':
+            self._writer.close()
+            os.replace(self.path + '.part', self.path)
+            self._exists = True
+        if self._file is not None:
+            self._file.close()
+            self._exists = True
+        self._writer = self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _parquet():
+    try:
+        import pyarrow.parquet as parquet
+    except ImportError:
+        raise Exception('Reading and writing Parquet files needs the pyarrow package.')
+    return parquet
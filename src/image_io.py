@@ -0,0 +1,65 @@
+"""
+Reading images and writing results without holding them in memory.
+
+Memory-mapped arrays are paged in and out by the operating system, and several
+processes opening the same file read-only share one copy of it.
+"""
+
+import os.path as path
+
+import numpy as np
+from skimage import io
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+def open_image(image_location, mmap=False):
+    """Open an image, memory-mapped if the file format allows it.
+
+    Parameters
+    ----------
+    image_location : str
+        Path to the image, file extension included.
+    mmap : bool, optional
+        When True, `.npy` files and uncompressed TIFF files are memory-mapped
+        read-only. Other files are read into memory.
+
+    Returns
+    -------
+    ndarray
+        The image, possibly a read-only `np.memmap`.
+    """
+
+    extension = path.splitext(image_location)[1][1:].lower()
+    if extension == 'npy':
+        return np.load(image_location, mmap_mode='r' if mmap else None)
+    if mmap and extension in ['tif', 'tiff'] and tifffile is not None:
+        try:
+            return tifffile.memmap(image_location, mode='r')
+        except ValueError:
+            pass  # compressed or not contiguous: fall back to reading it
+    return io.imread(image_location)
+
+
+def open_output(file, shape, dtype):
+    """Create a memory-mapped `.npy` file to be used as the output of a step.
+
+    Parameters
+    ----------
+    file : str
+        Path to the `.npy` file to be created.
+    shape : tuple of int
+        Shape of the output.
+    dtype : data-type
+        Data type of the output.
+
+    Returns
+    -------
+    np.memmap
+        Zero-initialized array backed by the file.
+    """
+
+    return np.lib.format.open_memmap(file, mode='w+', dtype=dtype, shape=shape)
@@ -0,0 +1,159 @@
+"""
+Local update of the watershed segmentation after manual corrections.
+
+The regions of the corrected image (e.g. the merged superpixels after some
+were split or merged by hand) go through the last steps of the workflow:
+grain boundaries, skeleton and watershed segmentation. When the regions are
+edited, only a window around the edit is reprocessed: the boundaries change
+next to the edited pixels only, the skeleton a few pixels further, and the
+watershed only in the grains touching the changed skeleton. The new labels
+of the window are matched to the old ones, so the unaffected grains keep
+their labels, and are written back into the global label image.
+"""
+
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+from skimage import segmentation
+from skimage.morphology import skeletonize, watershed
+
+# Also used from the ImagePy plugins, where the modules are in a package
+try:
+    from .gala_light import extended_minima_markers
+    from .tiling import expand
+except ImportError:
+    from gala_light import extended_minima_markers
+    from tiling import expand
+
+
+def bounding_box(mask):
+    """Smallest region containing the True pixels of a 2D mask, or None if there are none."""
+    rows, cols = np.any(mask, axis=1), np.any(mask, axis=0)
+    if not rows.any():
+        return None
+    row_indices, col_indices = np.flatnonzero(rows), np.flatnonzero(cols)
+    return (slice(row_indices[0], row_indices[-1] + 1), slice(col_indices[0], col_indices[-1] + 1))
+
+
+def watershed_from_skeleton(skeleton, h=2):
+    """Watershed segmentation of the grains delimited by a skeleton, as in the usual workflow."""
+    distance_function = np.negative(distance_transform_edt(~skeleton))
+    return watershed(distance_function, extended_minima_markers(distance_function, h, method='queue'))
+
+
+class IncrementalSegmentation:
+    """Segmentation of a region image, updated locally when the regions change.
+
+    Attributes
+    ----------
+    regions : int ndarray
+        The current region image. Pixels of the same value touching each other
+        belong to the same region.
+    boundary : bool ndarray
+        Boundaries of the regions.
+    skeleton : bool ndarray
+        Skeleton of the boundaries.
+    labels : int32 ndarray
+        Watershed segmentation of the skeleton, labelled from 1.
+    n_labels : int
+        Largest label used so far. Grains created by an update get new labels.
+    h : float
+        Depth of the extended minima used as watershed markers.
+    halo : int
+        Width of the margin around the affected grains in which the watershed
+        is recomputed. It should be at least the size of the largest grain;
+        it is doubled automatically when a grain reaches the window border.
+    """
+
+    # Distance up to which thinning may change the skeleton around a changed boundary
+    SKELETON_MARGIN = 8
+
+    def __init__(self, regions, h=2, halo=64):
+        self.regions = np.array(regions)
+        self.h = h
+        self.halo = halo
+        self.boundary = segmentation.find_boundaries(self.regions)
+        self.skeleton = skeletonize(self.boundary)
+        self.labels = watershed_from_skeleton(self.skeleton, h).astype(np.int32)
+        self.n_labels = int(self.labels.max())
+
+    def update(self, regions):
+        """Take the edits of the region image into account.
+
+        Parameters
+        ----------
+        regions : int ndarray
+            The edited region image, of the same shape as `regions`.
+
+        Returns
+        -------
+        tuple of slice or None
+            The region of the label image that was rewritten, None if nothing
+            has changed.
+        """
+
+        edit = bounding_box(regions != self.regions)
+        if edit is None:
+            return None
+        shape = self.regions.shape
+        self.regions[edit] = regions[edit]
+        # A boundary pixel only depends on its direct neighbours
+        changed, _ = expand(edit, 1, shape)
+        window, crop = expand(changed, 1, shape)
+        self.boundary[changed] = segmentation.find_boundaries(self.regions[window])[crop]
+        # The thinning is local, but can move the skeleton a few pixels away from the change
+        changed, _ = expand(changed, self.SKELETON_MARGIN, shape)
+        window, crop = expand(changed, self.SKELETON_MARGIN, shape)
+        self.skeleton[changed] = skeletonize(self.boundary[window])[crop]
+        return self._update_labels(changed)
+
+    def _update_labels(self, changed):
+        """Recompute the watershed segmentation of the grains touching a changed region.
+
+        Returns the rewritten window of the label image.
+        """
+        shape = self.labels.shape
+        touched = np.unique(self.labels[changed])
+        affected = bounding_box(np.isin(self.labels, touched))
+        halo = self.halo
+        while True:
+            window, _ = expand(affected, halo, shape)
+            labels = watershed_from_skeleton(self.skeleton[window], self.h)
+            old = self.labels[window]
+            local_changed = tuple(slice(c.start - w.start, c.stop - w.start) for c, w in zip(changed, window))
+            new_touched = np.unique(labels[local_changed])
+            rewrite = np.isin(old, touched) | np.isin(labels, new_touched)
+            # The grains to rewrite must not be cut by the window, unless it is the image border
+            cut = [rewrite[0].any() and window[0].start > 0, rewrite[-1].any() and window[0].stop < shape[0],
+                   rewrite[:, 0].any() and window[1].start > 0, rewrite[:, -1].any() and window[1].stop < shape[1]]
+            if not any(cut):
+                break
+            halo *= 2
+        self.labels[window][rewrite] = self._match(old, labels, rewrite)[labels[rewrite]]
+        return window
+
+    def _match(self, old, new, rewrite):
+        """Lookup table from the new labels to the old ones, or to new global labels.
+
+        The pairs of new and old labels are taken in decreasing order of their
+        overlap, each label being used at most once. When a grain was split,
+        its larger part therefore keeps the label, the other part gets a new one.
+        """
+
+        new_labels = new[rewrite].astype(np.int64)
+        old_labels = old[rewrite].astype(np.int64)
+        lut = np.zeros(int(new.max()) + 1, dtype=np.int64)
+        pairs, counts = np.unique(new_labels * (int(old_labels.max()) + 1) + old_labels, return_counts=True)
+        pair_new, pair_old = np.divmod(pairs, int(old_labels.max()) + 1)
+        # Largest overlaps first; each new and each old label is used at most once
+        order = np.argsort(-counts, kind='mergesort')
+        used_new, used_old = set(), set()
+        for new_label, old_label in zip(pair_new[order], pair_old[order]):
+            if new_label in used_new or old_label in used_old:
+                continue
+            used_new.add(new_label)
+            used_old.add(old_label)
+            lut[new_label] = old_label
+        unmatched = np.setdiff1d(np.unique(new_labels), np.fromiter(used_new, dtype=np.int64))
+        lut[unmatched] = self.n_labels + np.arange(1, unmatched.size + 1)
+        self.n_labels += unmatched.size
+        return lut
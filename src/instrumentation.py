@@ -0,0 +1,176 @@
+"""
+Run time and memory measurements of the segmentation steps.
+
+When profiling is enabled, each step records its wall time, CPU time, peak
+memory, the shapes and data types of its input and output arrays and the
+number of dilation passes of the iterative morphological reconstruction.
+The records are collected into a report that can be exported as JSON and
+aggregated over many images. When profiling is disabled, nothing is measured.
+"""
+
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+import gala_light
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def _describe(array):
+    """Shape, data type and size of an array."""
+    return {'shape': list(np.shape(array)), 'dtype': str(np.asarray(array).dtype),
+            'bytes': int(np.asarray(array).nbytes)}
+
+
+def _max_rss():
+    """Peak resident set size of the process in bytes, or None if unknown."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # kilobytes on Linux
+
+
+class StepRecord:
+    """Measurements of one call of a step.
+
+    Attributes
+    ----------
+    step : str
+        Name of the step.
+    wall_time : float
+        Elapsed time in seconds.
+    cpu_time : float
+        CPU time of the process in seconds.
+    peak_memory : int or None
+        Largest amount of memory allocated during the step in bytes, as traced
+        by `tracemalloc`, on top of what was allocated before. None when the
+        memory allocations are not traced.
+    max_rss : int or None
+        Peak resident set size of the process after the step in bytes.
+    inputs : list of dict
+        Shape, data type and size of the input arrays.
+    output : dict or None
+        Shape, data type and size of the output array.
+    reconstruction_iterations : int
+        Dilation passes of the iterative morphological reconstruction.
+    """
+
+    def __init__(self, step, inputs):
+        self.step = step
+        self.inputs = [_describe(array) for array in inputs]
+        self.output = None
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_memory = None
+        self.max_rss = None
+        self.reconstruction_iterations = 0
+
+    def set_output(self, array):
+        self.output = _describe(array)
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class Profiler:
+    """Collects the measurements of the steps.
+
+    Attributes
+    ----------
+    enabled : bool
+        When False, `measure` does not measure anything.
+    trace_memory : bool
+        When True, the memory allocations are traced with `tracemalloc` to
+        find the peak memory of each step. This slows down the code creating
+        many Python objects.
+    records : list of StepRecord
+        Measurements in the order the steps were called.
+    """
+
+    def __init__(self, enabled=True, trace_memory=True):
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.records = []
+
+    @contextmanager
+    def measure(self, step, inputs=()):
+        """Measure the code executed in the context.
+
+        Parameters
+        ----------
+        step : str
+            Name of the step.
+        inputs : sequence of ndarray, optional
+            Input arrays of the step.
+
+        Yields
+        ------
+        StepRecord or None
+            The record to which the output can be attached, None when disabled.
+        """
+
+        if not self.enabled:
+            yield None
+            return
+        record = StepRecord(step, inputs)
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        if self.trace_memory:
+            baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        iterations = gala_light.reconstruction_statistics['iterations']
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record.wall_time = time.perf_counter() - wall
+            record.cpu_time = time.process_time() - cpu
+            if self.trace_memory:
+                record.peak_memory = tracemalloc.get_traced_memory()[1] - baseline
+            record.max_rss = _max_rss()
+            record.reconstruction_iterations = gala_light.reconstruction_statistics['iterations'] - iterations
+            if started_tracing:
+                tracemalloc.stop()
+            self.records.append(record)
+
+    def report(self):
+        """Measurements as a list of dictionaries, one per step call."""
+        return [record.as_dict() for record in self.records]
+
+    def summary(self):
+        """Total wall time, CPU time and largest peak memory of each step."""
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record.step, {'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0,
+                                                    'peak_memory': None})
+            total['calls'] += 1
+            total['wall_time'] += record.wall_time
+            total['cpu_time'] += record.cpu_time
+            if record.peak_memory is not None:
+                total['peak_memory'] = max(total['peak_memory'] or 0, record.peak_memory)
+        return totals
+
+    def to_json(self, file=None):
+        """Export the report as JSON.
+
+        Parameters
+        ----------
+        file : str, optional
+            Path to the JSON file. If not given, the JSON text is returned.
+        """
+
+        text = json.dumps({'steps': self.report(), 'summary': self.summary()}, indent=2)
+        if file is None:
+            return text
+        with open(file, 'w') as f:
+            f.write(text)
+
+    def clear(self):
+        self.records = []
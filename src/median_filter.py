@@ -0,0 +1,84 @@
+"""
+Median filter of colour images, channel by channel.
+
+For 8-bit (and low bit depth 16-bit) images, the median is computed from a
+sliding histogram (Huang's algorithm, as implemented by the rank filters of
+scikit-image), whose cost per pixel grows with the side of the window and not
+with its area. The image is split into horizontal strips that are filtered in
+parallel threads. The result is the same as that of `scipy.ndimage.median_filter`
+applied separately on each channel with a square window.
+"""
+
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.ndimage as ndi
+from skimage.filters import rank
+
+
+# Above this many grey levels, scanning the histogram is slower than sorting the window
+MAX_HISTOGRAM_BINS = 4096
+# Below this window size, sorting the window is faster than updating the histogram
+MIN_HISTOGRAM_WINDOW = 5
+
+
+def median_filter(image, window_size, output=None, workers=None):
+    """Median filtering with a square window in each channel.
+
+    Parameters
+    ----------
+    image : 2D ndarray or 3D ndarray with the channels in the third dimension
+        Input image.
+    window_size : int
+        Size of the square sampling window.
+    output : ndarray, optional
+        Array of the shape and dtype of `image` to write the result into.
+    workers : int, optional
+        Number of threads. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    output : ndarray
+        Filtered image. The image borders are handled by reflection, as in
+        `scipy.ndimage.median_filter`.
+    """
+
+    image = np.asarray(image)
+    if output is None:
+        output = np.empty_like(image)
+    # Even windows are not centred the same way by the rank filters
+    fast = window_size % 2 == 1 and window_size >= MIN_HISTOGRAM_WINDOW and (
+        image.dtype == np.uint8 or (image.dtype == np.uint16 and image.max() < MAX_HISTOGRAM_BINS))
+    if not fast:
+        ndi.median_filter(image, size=(window_size, window_size) + (1,) * (image.ndim - 2),
+                          output=output)
+        return output
+
+    channels = image if image.ndim == 3 else image[:, :, np.newaxis]
+    filtered_channels = output if output.ndim == 3 else output[:, :, np.newaxis]
+    rows, cols, n_channels = channels.shape
+    radius = window_size // 2
+    footprint = np.ones((window_size, window_size), dtype=np.uint8)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    strip_height = max(-(-rows // workers), window_size)
+
+    def filter_strip(task):
+        channel, start = task
+        stop = min(start + strip_height, rows)
+        # Neighbouring rows are read from the image, reflection is only needed at the borders
+        first, last = max(start - radius, 0), min(stop + radius, rows)
+        padding = ((radius - (start - first), radius - (last - stop)), (radius, radius))
+        strip = np.pad(channels[first:last, :, channel], padding, mode='symmetric')
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # performance warning about the number of bins
+            filtered = rank.median(strip, footprint)
+        filtered_channels[start:stop, :, channel] = filtered[radius:radius + stop - start,
+                                                             radius:radius + cols]
+
+    tasks = [(channel, start) for channel in range(n_channels) for start in range(0, rows, strip_height)]
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(filter_strip, tasks))
+    return output
@@ -0,0 +1,163 @@
+"""
+Minima tree (dynamics of the minima) of an image, for fast h-minima sweeps.
+
+The extended minima of an image for a depth `h` are the regional minima of
+its h-minima transform. Instead of computing the transform again for every h,
+the catchment basins of all the regional minima are found once, and the
+basins are merged in the order of the lowest pass between them (Kruskal's
+algorithm). Every node of the resulting tree is a connected component of a
+lower level set of the image, alive from the level it appears at to the level
+where it merges with another component. A node is an extended minimum for h
+if its minimum plus h lies in that interval, and its pixels are those of its
+basins not higher than its minimum plus h. The markers of any h are therefore
+obtained from the tree with a lookup table and a comparison per pixel.
+"""
+
+import numpy as np
+import scipy.ndimage as ndi
+from skimage.morphology import watershed
+
+from gala_light import label_regional_minima
+
+
+class MinimaTree:
+    """Component tree of the regional minima of an image.
+
+    Attributes
+    ----------
+    image : ndarray
+        The image, whose extended minima are sought.
+    basins : int32 ndarray
+        Catchment basins of the regional minima, labelled from 1.
+    levels : float ndarray
+        Level at which each node appears: the minimum of the leaves (one per
+        basin), the pass value of the other nodes.
+    minima : float ndarray
+        Smallest value of each node.
+    parents : int ndarray
+        Parent of each node, -1 for the root(s).
+    """
+
+    def __init__(self, image, connectivity=1):
+        """Build the tree.
+
+        Parameters
+        ----------
+        image : ndarray
+            The image, e.g. a negative distance function.
+        connectivity : int, optional
+            Neighborhood of the pixels, as in `gala_light.imextendedmin`.
+        """
+
+        self.image = image
+        self.connectivity = connectivity
+        minima = label_regional_minima(image, connectivity, label_connectivity=connectivity)
+        n_basins = int(minima.max())
+        self.basins = watershed(image, minima, connectivity=connectivity).astype(np.int32, copy=False)
+        leaf_minima = np.asarray(ndi.minimum(image, minima, np.arange(1, n_basins + 1)), dtype=float)
+        sources, targets, passes = self._passes()
+
+        # Kruskal's algorithm: each merge of two components creates a new node
+        n_nodes = 2 * n_basins - 1 if n_basins else 0
+        self.levels = np.empty(n_nodes)
+        self.minima = np.empty(n_nodes)
+        self.parents = np.full(n_nodes, -1, dtype=np.intp)
+        self.levels[:n_basins] = leaf_minima
+        self.minima[:n_basins] = leaf_minima
+        component = np.arange(n_basins)  # union-find forest of the basins
+        root_node = np.arange(n_basins)  # tree node of each union-find root
+
+        def find(basin):
+            root = basin
+            while component[root] != root:
+                root = component[root]
+            while component[basin] != root:  # path compression
+                component[basin], basin = root, component[basin]
+            return root
+
+        node = n_basins
+        for edge in np.argsort(passes, kind='mergesort'):
+            root_u, root_v = find(sources[edge]), find(targets[edge])
+            if root_u == root_v:
+                continue
+            child_u, child_v = root_node[root_u], root_node[root_v]
+            self.parents[child_u] = self.parents[child_v] = node
+            self.levels[node] = passes[edge]
+            self.minima[node] = min(self.minima[child_u], self.minima[child_v])
+            component[root_u] = root_v
+            root_node[root_v] = node
+            node += 1
+        # Nodes not created because some basins never meet (e.g. separated by a mask)
+        self.levels = self.levels[:node]
+        self.minima = self.minima[:node]
+        self.parents = self.parents[:node]
+        self.n_basins = n_basins
+
+    @property
+    def nbytes(self):
+        """Memory occupied by the tree, the image included."""
+        return self.image.nbytes + self.basins.nbytes + self.levels.nbytes + self.minima.nbytes + \
+            self.parents.nbytes
+
+    def _passes(self):
+        """Lowest pass value between each pair of adjacent basins."""
+        sel = ndi.generate_binary_structure(self.image.ndim, self.connectivity)
+        sources, targets, passes = [], [], []
+        for offset in zip(*np.nonzero(sel)):
+            offset = tuple(o - 1 for o in offset)
+            if offset <= (0,) * self.image.ndim:  # each pair of neighbours once
+                continue
+            first = tuple(slice(max(-o, 0), n - max(o, 0)) for o, n in zip(offset, self.image.shape))
+            second = tuple(slice(max(o, 0), n - max(-o, 0)) for o, n in zip(offset, self.image.shape))
+            different = self.basins[first] != self.basins[second]
+            sources.append(self.basins[first][different])
+            targets.append(self.basins[second][different])
+            passes.append(np.maximum(self.image[first][different], self.image[second][different]))
+        sources = np.concatenate(sources).astype(np.intp) - 1
+        targets = np.concatenate(targets).astype(np.intp) - 1
+        passes = np.concatenate(passes).astype(float)
+        # Keep the lowest pass of each pair of basins
+        low, high = np.minimum(sources, targets), np.maximum(sources, targets)
+        order = np.lexsort((passes, high, low))
+        low, high, passes = low[order], high[order], passes[order]
+        first_of_pair = np.r_[True, (low[1:] != low[:-1]) | (high[1:] != high[:-1])][:low.size]
+        return low[first_of_pair], high[first_of_pair], passes[first_of_pair]
+
+    def markers(self, h):
+        """Labelled extended minima for a given depth.
+
+        Same as `gala_light.extended_minima_markers(image, h, connectivity)`.
+
+        Parameters
+        ----------
+        h : float
+            Any local minima shallower than this will be flattened.
+
+        Returns
+        -------
+        int32 ndarray
+            Labels of the extended minima starting from 1, 0 elsewhere. As in
+            `extended_minima_markers`, minima touching only diagonally share
+            a label.
+        """
+
+        n_nodes = self.parents.size
+        if n_nodes == 0:
+            return np.zeros(self.image.shape, dtype=np.int32)
+        tops = self.minima + h
+        parent_levels = np.where(self.parents >= 0, self.levels[self.parents], np.inf)
+        qualifies = (self.levels <= tops) & (tops < parent_levels)
+        # Nearest qualifying node on the way to the root; parents are created after their children
+        owner = np.where(qualifies, np.arange(n_nodes), -1)
+        for node in range(n_nodes - 1, -1, -1):
+            if owner[node] < 0 and self.parents[node] >= 0:
+                owner[node] = owner[self.parents[node]]
+        leaf_owner = np.r_[-1, owner[:self.n_basins]]
+        pixel_owner = leaf_owner[self.basins]
+        # Pixels of basins that belong to no extended minimum are compared against -inf
+        thresholds = np.r_[tops, -np.inf]
+        extended = self.image <= thresholds[pixel_owner]
+        # Labelled with full connectivity, in raster order, as the extended minima are
+        markers = np.zeros(self.image.shape, dtype=np.int32)
+        ndi.label(extended, structure=np.ones((3,) * self.image.ndim), output=markers)
+        return markers
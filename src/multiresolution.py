@@ -0,0 +1,94 @@
+"""
+Coarse-to-fine segmentation.
+
+The quick shift segmentation and the merging of its clusters take a time
+growing faster than the number of pixels, while the grains are usually
+hundreds of pixels across. These steps are therefore run on an image
+downsampled by an integer factor. The merged labels are upsampled to the
+full resolution, where they are only uncertain in a band along the
+boundaries. The pixels of the band are relabelled by a watershed of the
+colour gradient of the full-resolution image, seeded by the labels around
+the band, so the boundaries follow the image again.
+"""
+
+import numpy as np
+import scipy.ndimage as ndi
+from skimage import filters, segmentation
+from skimage.morphology import watershed
+
+from labelling import label_dtype
+
+
+def block_mean(image, factor):
+    """Downsample an image by averaging blocks of `factor` x `factor` pixels.
+
+    The image is padded by repeating its last rows and columns when its size
+    is not a multiple of `factor`. The result has the type of the image.
+    """
+
+    image = np.asarray(image)
+    if factor == 1:
+        return np.array(image)
+    rows, cols = -(-image.shape[0] // factor), -(-image.shape[1] // factor)
+    padding = [(0, rows * factor - image.shape[0]), (0, cols * factor - image.shape[1])]
+    padded = np.pad(image, padding + [(0, 0)] * (image.ndim - 2), mode='edge')
+    blocks = padded.reshape((rows, factor, cols, factor) + image.shape[2:])
+    mean = blocks.mean(axis=(1, 3))
+    if image.dtype.kind in 'iub':
+        mean = np.rint(mean)
+    return mean.astype(image.dtype)
+
+
+def upsample_labels(labels, factor, shape):
+    """Label image of size `shape` in which each label covers its pixel block."""
+    return labels.repeat(factor, axis=0).repeat(factor, axis=1)[:shape[0], :shape[1]]
+
+
+def color_gradient(image):
+    """Sum of the Sobel gradient magnitudes of the channels of an image."""
+    image = np.asarray(image, dtype=float)
+    if image.ndim == 2:
+        return filters.sobel(image)
+    return sum(filters.sobel(image[..., channel]) for channel in range(image.shape[2]))
+
+
+def refine_labels(coarse_labels, image, factor, margin=1):
+    """Upsample a label image and move its boundaries onto the edges of the image.
+
+    Parameters
+    ----------
+    coarse_labels : int ndarray
+        Labels computed on the image downsampled by `factor` (see `block_mean`).
+    image : ndarray
+        The full-resolution image.
+    factor : int
+        Downsampling factor of `coarse_labels`.
+    margin : int, optional
+        Half width of the refined band around the coarse boundaries, in coarse
+        pixels, in addition to the boundary pixels themselves.
+
+    Returns
+    -------
+    ndarray
+        Label image of the size of `image`, with the labels of `coarse_labels`.
+    """
+
+    shape = np.shape(image)[:2]
+    # Shifted so that no label is 0, the unlabelled value of the watershed
+    coarse_labels = np.asarray(coarse_labels)
+    coarse = coarse_labels.astype(label_dtype(int(coarse_labels.max()) + 1)) + 1
+    labels = upsample_labels(coarse, factor, shape)
+    coarse_band = segmentation.find_boundaries(coarse_labels, mode='thick')
+    if margin > 0 and coarse_band.any():
+        coarse_band = ndi.binary_dilation(coarse_band, iterations=margin)
+    band = upsample_labels(coarse_band, factor, shape)
+    if band.all() or not band.any():
+        return labels - 1
+    # The watershed floods the band from the labelled pixels just outside it
+    region = ndi.binary_dilation(band)
+    markers = np.where(band, 0, labels)
+    refined = watershed(color_gradient(image), markers, mask=region)
+    # Pixels of the band that no marker reaches keep their coarse label
+    band &= refined > 0
+    labels[band] = refined[band]
+    return labels - 1
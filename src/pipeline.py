@@ -0,0 +1,178 @@
+"""
+Lazily evaluated segmentation pipeline.
+
+The steps of the segmentation and their parameters are recorded as a directed
+acyclic graph. A step is only computed when its result (or the result of a
+step depending on it) is requested, and its output is kept until one of its
+parameters, or a parameter of an upstream step, changes. Tuning, for example,
+the merge threshold therefore only recomputes the merging and the steps after
+it, while the filtered image and the quick shift segmentation are reused.
+
+Example:
+    pipeline = Pipeline(GrainSegmentation(image_path, interactive_mode=False))
+    labels = pipeline.result()
+    pipeline.set('merge_clusters', threshold=8)
+    labels = pipeline.result()  # filtering and quick shift are not rerun
+"""
+
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+
+# The steps of the usual workflow: name -> (names of the input steps, default parameters)
+WORKFLOW = OrderedDict([
+    ('filter_image', ((), {'window_size': 5})),
+    ('initial_segmentation', (('filter_image',), {})),
+    ('merge_clusters', (('initial_segmentation',), {'threshold': 5})),
+    ('find_grain_boundaries', (('merge_clusters',), {})),
+    ('create_skeleton', (('find_grain_boundaries',), {})),
+    ('watershed_segmentation', (('create_skeleton',), {})),
+])
+
+# The quick shift segmentation and the merging done on a downsampled image,
+# see `GrainSegmentation.coarse_to_fine_segmentation`
+COARSE_TO_FINE_WORKFLOW = OrderedDict([
+    ('filter_image', ((), {'window_size': 5})),
+    ('coarse_to_fine_segmentation', (('filter_image',), {'factor': 2, 'threshold': 5})),
+    ('find_grain_boundaries', (('coarse_to_fine_segmentation',), {})),
+    ('create_skeleton', (('find_grain_boundaries',), {})),
+    ('watershed_segmentation', (('create_skeleton',), {})),
+])
+
+
+def with_thin_boundaries(workflow=WORKFLOW):
+    """A workflow in which `find_grain_boundaries` and `create_skeleton` are replaced by `thin_boundaries`."""
+    fused = OrderedDict()
+    for name, (inputs, defaults) in workflow.items():
+        if name == 'find_grain_boundaries':
+            fused['thin_boundaries'] = (inputs, {})
+        elif name != 'create_skeleton':
+            fused[name] = (tuple('thin_boundaries' if input_name == 'create_skeleton' else input_name
+                                 for input_name in inputs), defaults)
+    return fused
+
+
+Step = namedtuple('Step', ['function', 'inputs', 'parameters'])
+
+
+def _same(a, b):
+    """Whether two parameter values are equal. Arrays are only equal to themselves."""
+    if a is b:
+        return True
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return False
+    return type(a) == type(b) and a == b
+
+
+class Pipeline:
+    """Graph of segmentation steps with memoized results.
+
+    Attributes
+    ----------
+    segmenter : GrainSegmentation
+        The object whose methods are the steps of the usual workflow.
+    evaluations : dict
+        Number of times each step has been computed.
+    """
+
+    def __init__(self, segmenter, parameters=None, workflow=WORKFLOW):
+        """Build the pipeline of a workflow.
+
+        Parameters
+        ----------
+        segmenter : GrainSegmentation
+            Object holding the image to be segmented.
+        parameters : dict, optional
+            Keyword arguments of the steps, e.g. {'merge_clusters': {'threshold': 7}}.
+            The steps not mentioned use the default parameters of `workflow`.
+        workflow : OrderedDict, optional
+            The steps, their inputs and default parameters, e.g. `WORKFLOW`
+            (default) or `COARSE_TO_FINE_WORKFLOW`.
+        """
+
+        self.segmenter = segmenter
+        self.evaluations = {}
+        self._steps = OrderedDict()
+        self._results = {}
+        for name, (inputs, defaults) in workflow.items():
+            self.add_step(name, getattr(segmenter, name), inputs, **defaults)
+        for name, kwargs in (parameters or {}).items():
+            self.set(name, **kwargs)
+
+    @property
+    def steps(self):
+        """Names of the steps, in the order they were added."""
+        return list(self._steps)
+
+    def add_step(self, name, function, inputs=(), **parameters):
+        """Add a step, or replace an existing one.
+
+        Parameters
+        ----------
+        name : str
+            Name of the step.
+        function : callable
+            Called with the results of the input steps as positional arguments
+            and with the parameters as keyword arguments.
+        inputs : sequence of str, optional
+            Names of the steps whose results are the inputs of this step.
+        **parameters
+            Keyword arguments of `function`.
+        """
+
+        for input_name in inputs:
+            if input_name not in self._steps:
+                raise Exception('Unknown input step {0}. Choose from: {1}.'.format(input_name, self.steps))
+        self.invalidate(name)
+        self._steps[name] = Step(function, tuple(inputs), dict(parameters))
+        self.evaluations.setdefault(name, 0)
+
+    def parameters(self, name):
+        """Current parameters of a step."""
+        return dict(self._step(name).parameters)
+
+    def set(self, name, **parameters):
+        """Change parameters of a step.
+
+        The results of the step and of the steps depending on it are discarded,
+        unless all the given values equal the current ones.
+        """
+
+        step = self._step(name)
+        changed = [key for key, value in parameters.items()
+                   if key not in step.parameters or not _same(step.parameters[key], value)]
+        if changed:
+            step.parameters.update(parameters)
+            self.invalidate(name)
+
+    def dependents(self, name):
+        """Names of the step and of all the steps depending on it."""
+        found = [name]
+        for step_name, step in self._steps.items():  # inputs are always added before their dependents
+            if any(input_name in found for input_name in step.inputs):
+                found.append(step_name)
+        return found
+
+    def invalidate(self, name):
+        """Discard the results of a step and of the steps depending on it."""
+        for step_name in self.dependents(name):
+            self._results.pop(step_name, None)
+
+    def is_computed(self, name):
+        """Whether the result of a step is available without computation."""
+        return name in self._results
+
+    def result(self, name='watershed_segmentation'):
+        """Result of a step, computing it and its inputs only if needed."""
+        if name not in self._results:
+            step = self._step(name)
+            inputs = [self.result(input_name) for input_name in step.inputs]
+            self._results[name] = step.function(*inputs, **step.parameters)
+            self.evaluations[name] += 1
+        return self._results[name]
+
+    def _step(self, name):
+        if name not in self._steps:
+            raise Exception('Unknown step {0}. Choose from: {1}.'.format(name, self.steps))
+        return self._steps[name]
@@ -0,0 +1,170 @@
+"""
+Previews of the intermediate results of the segmentation.
+
+Showing every full-resolution intermediate image with `io.imshow` and
+`io.show` blocks the computation until the window is closed, and rendering
+multi-megapixel arrays with matplotlib can take longer than the step itself.
+The previews are therefore downsampled before being rendered, and they are
+rendered in a background thread while the computation continues. They are
+either shown in windows owned by a separate process, or written as PNG files.
+"""
+
+import atexit
+import multiprocessing
+import os
+import os.path as path
+import queue
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from skimage import io
+
+
+# Ways of showing the previews
+PREVIEW_MODES = ['window', 'files', 'blocking']
+
+
+def downsample(array, max_size):
+    """Every n-th pixel of an image, so that its sides are at most `max_size`.
+
+    Nearest-neighbour sampling keeps label images valid. Binary images are
+    reduced by taking the maximum of each block instead, so that thin lines
+    (e.g. a skeleton) do not disappear. A copy is returned, so the preview is
+    not affected by later changes of `array`.
+    """
+
+    step = max(1, -(-max(np.shape(array)[:2]) // max_size))
+    if step == 1:
+        return np.array(array)
+    if array.dtype == bool:
+        rows, cols = -(-array.shape[0] // step), -(-array.shape[1] // step)
+        padded = np.zeros((rows * step, cols * step), dtype=bool)
+        padded[:array.shape[0], :array.shape[1]] = array
+        return padded.reshape(rows, step, cols, step).any(axis=(1, 3))
+    return np.array(array[::step, ::step])
+
+
+def _display(images):
+    """Show the images arriving on a queue in windows, until None arrives."""
+    import matplotlib.pyplot as plt
+
+    while True:
+        try:
+            item = images.get(timeout=0.1)
+        except queue.Empty:
+            if plt.get_fignums():
+                plt.pause(0.1)  # keep the open windows responsive
+            continue
+        if item is None:
+            break
+        title, image = item
+        plt.figure(title)
+        plt.imshow(image, cmap='gray')
+        plt.axis('off')
+        plt.pause(0.001)
+    if plt.get_fignums():
+        plt.show()  # the windows stay open until the user closes them
+
+
+def _report_failure(future):
+    """Print why a preview could not be rendered or saved; the computation goes on."""
+    error = None if future.cancelled() else future.exception()
+    if error is not None:
+        print('The preview could not be shown:')
+        traceback.print_exception(type(error), error, error.__traceback__)
+
+
+class Previewer:
+    """Renders and shows downsampled previews without stopping the computation.
+
+    Attributes
+    ----------
+    mode : {'window', 'files', 'blocking'}
+        'window': the previews are shown in windows of a separate process.
+        'files': the previews are written as PNG files into `directory`
+        (headless mode).
+        'blocking': each preview is shown with `io.imshow` and the computation
+        continues when its window is closed.
+    directory : str or None
+        Directory of the preview files.
+    max_size : int
+        Maximum side length of the previews in pixels.
+    """
+
+    def __init__(self, mode='window', directory=None, max_size=1024):
+        if mode not in PREVIEW_MODES:
+            raise Exception('Unknown preview mode {0}. Choose from: {1}.'.format(mode, PREVIEW_MODES))
+        if mode == 'files':
+            if directory is None:
+                raise Exception('A directory is needed to save the previews.')
+            os.makedirs(directory, exist_ok=True)
+        self.mode = mode
+        self.directory = directory
+        self.max_size = max_size
+        self._count = 0
+        self._executor = None  # created by the first preview, shut down by `close`
+        self._images = None
+        self._display_process = None
+
+    def show(self, name, render, *arrays):
+        """Preview an intermediate result.
+
+        Parameters
+        ----------
+        name : str
+            Name of the preview, used as window title or file name.
+        render : callable
+            Creates the image to be shown from the downsampled `arrays`.
+        *arrays : ndarray
+            Images of the same size, downsampled before being rendered.
+        """
+
+        self._count += 1
+        small = [downsample(array, self.max_size) for array in arrays]
+        title = '{0:02d}_{1}'.format(self._count, name)
+        if self.mode == 'blocking':
+            io.imshow(render(*small))
+            io.show()
+            return
+        if self.mode == 'window' and self._display_process is None:
+            # Started from the main thread, forking does not rerun the main script;
+            # matplotlib is only imported in the child
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+            self._images = context.Queue()
+            self._display_process = context.Process(target=_display, args=(self._images,))
+            self._display_process.start()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1)
+            atexit.register(self.close)
+        self._executor.submit(self._output, title, render, small).add_done_callback(_report_failure)
+
+    def _output(self, title, render, arrays):
+        image = render(*arrays)
+        if self.mode == 'files':
+            if image.dtype == bool:
+                image = image.astype(np.uint8) * 255
+            elif image.dtype.kind == 'f':
+                image = (np.clip(image, 0, 1) * 255).astype(np.uint8)
+            io.imsave(path.join(self.directory, title + '.png'), image, check_contrast=False)
+        else:
+            self._images.put((title, image))
+
+    def close(self):
+        """Wait until the pending previews are rendered and release the rendering thread.
+
+        The preview windows stay open until they are closed by the user. Later
+        previews start a new thread (and display process) as needed.
+        """
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            atexit.unregister(self.close)
+        if self._images is not None:
+            if not self._display_process.is_alive():
+                self._images.cancel_join_thread()  # nobody will read the queue
+            self._images.put(None)
+            self._images = None
+            self._display_process = None
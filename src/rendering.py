@@ -0,0 +1,124 @@
+"""
+Painting label images with the average colour of their regions.
+
+This gives the same image as
+`skimage.color.label2rgb(labels, image, kind='avg', bg_label=-1)`, label 0
+being painted with its colour too, without looping over the labels: the
+colour sums of all the labels are computed at once with `np.bincount`, and
+the output is gathered from a small table of colours. After merging regions,
+the sums of the merged regions are obtained from those of the original ones,
+so the image is not read again.
+"""
+
+import numpy as np
+
+
+class MeanColorRenderer:
+    """Average colour rendering of a label image and of its merged versions.
+
+    Attributes
+    ----------
+    labels : int ndarray
+        The label image, with non-negative labels.
+    sums : float ndarray
+        Colour sums of the labels, one row per label and one column per channel.
+    counts : int ndarray
+        Number of pixels of the labels.
+    dtype : numpy.dtype
+        Data type of the image and of the rendered images.
+    bg_label : int
+        Label painted with `bg_color` instead of its average colour, as done by
+        `label2rgb`, or -1 for none.
+    bg_color : tuple
+        Colour of the background label.
+    """
+
+    def __init__(self, image, labels, bg_label=-1, bg_color=(0, 0, 0)):
+        """
+        Parameters
+        ----------
+        image : ndarray
+            Colour image, with the channels in the last dimension.
+        labels : int ndarray
+            Label image of the same size as `image`.
+        bg_label : int, optional
+            Label of the background. By default there is none and every label
+            is painted with its colour: label 0 is a region of the quick shift
+            segmentation and of the merged clusters.
+        bg_color : tuple, optional
+            Colour of the background label.
+        """
+
+        image = np.asarray(image)
+        self.labels = np.asarray(labels)
+        self.dtype = image.dtype
+        self.bg_label = bg_label
+        self.bg_color = bg_color
+        flat_labels = self.labels.ravel()
+        n_labels = int(flat_labels.max()) + 1 if flat_labels.size else 1
+        channels = image.reshape(flat_labels.size, -1)
+        self.counts = np.bincount(flat_labels, minlength=n_labels)
+        self.sums = np.column_stack([np.bincount(flat_labels, weights=channels[:, channel], minlength=n_labels)
+                                     for channel in range(channels.shape[1])])
+
+    def palette(self, lut=None):
+        """Colour of each label of the label image.
+
+        Parameters
+        ----------
+        lut : int ndarray, optional
+            Mapping of the labels to merged labels (e.g. from
+            `MergeTree.lookup_table`). The labels are then painted with the
+            average colour of the merged region they belong to.
+
+        Returns
+        -------
+        ndarray
+            One row per label of `labels`, of type `dtype`.
+        """
+
+        n_labels = self.counts.size
+        if lut is None:
+            sums, counts, merged = self.sums, self.counts, np.arange(n_labels)
+        else:
+            merged = np.asarray(lut)[:n_labels]
+            n_merged = int(merged.max()) + 1
+            counts = np.bincount(merged, weights=self.counts, minlength=n_merged)
+            sums = np.column_stack([np.bincount(merged, weights=self.sums[:, channel], minlength=n_merged)
+                                    for channel in range(self.sums.shape[1])])
+        means = sums / np.maximum(counts, 1)[:, np.newaxis]
+        # Truncated like the assignment of the mean to the output in label2rgb
+        colors = means[merged].astype(self.dtype)
+        colors[merged == self.bg_label] = self.bg_color
+        return colors
+
+    def render(self, lut=None, out=None):
+        """Paint each region with its average colour.
+
+        Parameters
+        ----------
+        lut : int ndarray, optional
+            Mapping of the labels to merged labels, see `palette`.
+        out : ndarray, optional
+            Array of the shape of the image to write the result into.
+
+        Returns
+        -------
+        out : ndarray
+            The rendered image.
+        """
+
+        colors = self.palette(lut)
+        if out is None:
+            return colors[self.labels]
+        np.take(colors, self.labels, axis=0, out=out)
+        return out
+
+
+def average_colors(labels, image):
+    """Each label painted with the average colour of the image under it.
+
+    Same as `skimage.color.label2rgb(labels, image, kind='avg', bg_label=-1)`.
+    """
+
+    return MeanColorRenderer(image, labels).render()
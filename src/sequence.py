@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Segmentation of image sequences, warm-started from the previous frame.
+
+In in-situ experiments (e.g. heating), the grain structure changes slowly
+from frame to frame. Only the first frame goes through the whole workflow.
+For the next frames, the blocks of the image that differ from the image they
+were last segmented from are found, and the quick shift segmentation and the
+merging of the clusters are run on windows around them only. The merged
+regions of a window are matched to the regions around it, and the grain
+boundaries, the skeleton and the watershed segmentation are then updated
+locally with `incremental.IncrementalSegmentation`: the labels outside the
+grains touched by the change are kept, and the new grains are matched to the
+previous ones, so a grain keeps its label through the sequence.
+
+Example:
+    python sequence.py frames/ -o labels.npy -p parameters.json --threshold 8
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+import scipy.ndimage as ndi
+
+from batch import load_parameters
+from image_io import open_output
+from incremental import IncrementalSegmentation
+from multiresolution import block_mean
+from pipeline import Pipeline
+from tiling import expand, match_labels
+
+
+class SequenceSegmentation:
+    """Segmentation of the frames of a sequence, each one starting from the previous result.
+
+    Attributes
+    ----------
+    parameters : dict
+        Keyword arguments of the steps, see `batch.load_parameters`. The
+        watershed segmentation uses the `h` parameter only.
+    threshold : float
+        Mean absolute difference of a block, in grey levels, above which it is
+        segmented again. The frames are compared by their means over cells of
+        `CELL_SIZE` pixels, so that the noise of the camera cancels out.
+    block_size : int
+        Side length of the blocks the frames are compared by, a multiple of
+        `CELL_SIZE`.
+    halo : int
+        Width of the context around the changed blocks given to the quick
+        shift segmentation and the merging. It should be larger than the
+        typical grain.
+    reference : float32 ndarray or None
+        Cell means of the image each block was last segmented from.
+    regions : int64 ndarray or None
+        Merged regions of the current frame, labelled from 1.
+    incremental : IncrementalSegmentation or None
+        Boundaries, skeleton and watershed labels of the current frame.
+    n_regions : int
+        Largest region label used so far.
+    last_update : dict
+        Number of changed blocks and windows and time spent on the last frame.
+    """
+
+    # Side length of the cells averaged before comparing the frames
+    CELL_SIZE = 4
+
+    def __init__(self, parameters=None, threshold=8.0, block_size=32, halo=64, min_fraction=0.5):
+        """
+        Parameters
+        ----------
+        min_fraction : float, optional
+            Overlap fraction needed to match a new region to a region around
+            its window, see `tiling.match_labels`.
+        """
+
+        if block_size % self.CELL_SIZE:
+            raise Exception('The block size must be a multiple of {0}.'.format(self.CELL_SIZE))
+        self.parameters = load_parameters() if parameters is None else parameters
+        self.threshold = threshold
+        self.block_size = block_size
+        self.halo = halo
+        self.min_fraction = min_fraction
+        self.reference = None
+        self.regions = None
+        self.incremental = None
+        self.n_regions = 0
+        self.last_update = {}
+        self._shape = None
+
+    @property
+    def labels(self):
+        """Watershed labels of the current frame, consistent across the frames."""
+        return self.incremental.labels
+
+    def segment(self, frame):
+        """Segment the next frame.
+
+        Parameters
+        ----------
+        frame : 3D ndarray with size 3 in the third dimension
+            The frame, of the same size as the previous ones.
+
+        Returns
+        -------
+        int32 ndarray
+            The watershed labels. The array is updated in place by the next
+            call, copy it to keep it.
+        """
+
+        start = time.perf_counter()
+        frame = np.asarray(frame)
+        cells = block_mean(frame.astype(np.float32), self.CELL_SIZE)
+        if self._shape != frame.shape:
+            self._start(frame)
+            self.reference = cells
+            self.last_update = {'changed_blocks': None, 'windows': None, 'seconds': time.perf_counter() - start}
+            return self.labels
+        changed = self.changed_blocks(cells)
+        windows = ndi.find_objects(ndi.label(changed)[0])
+        ratio = self.block_size // self.CELL_SIZE
+        for blocks in windows:
+            core = tuple(slice(s.start * self.block_size, min(s.stop * self.block_size, n))
+                         for s, n in zip(blocks, frame.shape[:2]))
+            self._resegment(frame, core)
+            cell_core = tuple(slice(s.start * ratio, s.stop * ratio) for s in blocks)
+            self.reference[cell_core] = cells[cell_core]
+        if windows:
+            self.incremental.update(self.regions)
+        self.last_update = {'changed_blocks': int(np.count_nonzero(changed)), 'windows': len(windows),
+                            'seconds': time.perf_counter() - start}
+        return self.labels
+
+    def changed_blocks(self, cells):
+        """Blocks whose mean absolute difference to the reference exceeds the threshold.
+
+        Parameters
+        ----------
+        cells : float32 ndarray
+            Means of the frame over cells of `CELL_SIZE` pixels (see
+            `multiresolution.block_mean`).
+
+        Returns
+        -------
+        bool ndarray
+            One value per block.
+        """
+
+        difference = np.abs(cells - self.reference)
+        if difference.ndim == 3:
+            difference = difference.max(axis=2)
+        ratio = self.block_size // self.CELL_SIZE
+        starts = [np.arange(0, n, ratio) for n in difference.shape]
+        sums = np.add.reduceat(np.add.reduceat(difference, starts[0], axis=0), starts[1], axis=1)
+        counts = np.outer(*[np.diff(np.r_[start, n]) for start, n in zip(starts, difference.shape)])
+        return sums / counts > self.threshold
+
+    def _start(self, frame):
+        """Segment the first frame with the whole workflow."""
+        from grain_segmentation import GrainSegmentation
+
+        merged = Pipeline(GrainSegmentation.from_array(frame), self.parameters).result('merge_clusters')
+        self.regions = merged.astype(np.int64) + 1
+        self.n_regions = int(self.regions.max())
+        self._shape = frame.shape
+        h = self.parameters.get('watershed_segmentation', {}).get('h', 2)
+        self.incremental = IncrementalSegmentation(self.regions, h, self.halo)
+
+    def _resegment(self, frame, core):
+        """Merged regions of a changed part of the frame, matched to the regions around it."""
+        from grain_segmentation import GrainSegmentation
+
+        shape = frame.shape[:2]
+        window, crop = expand(core, self.halo, shape)
+        segmenter = GrainSegmentation.from_array(np.ascontiguousarray(frame[window]))
+        new = Pipeline(segmenter, self.parameters).result('merge_clusters').astype(np.int64) + 1
+        # Only the regions around the changed part are known
+        around = self.regions[window].copy()
+        around[crop] = 0
+        lut = match_labels(around, new, self.min_fraction)
+        present = np.zeros(lut.size, dtype=bool)
+        present[new[crop]] = True
+        unmatched = present & (lut == 0)
+        lut[unmatched] = self.n_regions + np.arange(1, np.count_nonzero(unmatched) + 1)
+        self.n_regions += np.count_nonzero(unmatched)
+        self.regions[core] = lut[new[crop]]
+
+
+def main(argv=None):
+    from stack import SliceReader
+
+    parser = argparse.ArgumentParser(description='Segment an image sequence, each frame starting from the '
+                                                 'previous one.')
+    parser.add_argument('source', help='multi-page TIFF file, 3D .npy file or directory of frames')
+    parser.add_argument('-o', '--output', required=True, help='.npy file of the labels of all the frames')
+    parser.add_argument('-p', '--parameters', help='JSON file with the parameters of the steps')
+    parser.add_argument('--threshold', type=float, default=8.0,
+                        help='mean grey level difference of a block to segment it again (default: 8)')
+    parser.add_argument('--block-size', type=int, default=32, help='side length of the blocks (default: 32)')
+    parser.add_argument('--halo', type=int, default=64,
+                        help='context around the changed blocks, larger than the grains (default: 64)')
+    args = parser.parse_args(argv)
+
+    frames = SliceReader(args.source)
+    sequence = SequenceSegmentation(load_parameters(args.parameters), args.threshold, args.block_size, args.halo)
+    volume = None
+    for index in range(len(frames)):
+        labels = sequence.segment(frames[index])
+        if volume is None:
+            volume = open_output(args.output, (len(frames),) + labels.shape, np.int32)
+        volume[index] = labels
+        update = sequence.last_update
+        print('Frame {0} of {1}: {2:.2f} s, {3} changed blocks, {4} grains so far'.format(
+            index + 1, len(frames), update['seconds'],
+            'all' if update['changed_blocks'] is None else update['changed_blocks'], sequence.incremental.n_labels))
+    volume.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Segmentation of 3D image stacks, one slice at a time.
+
+The slices of a serial-sectioning or FIB-SEM stack, stored as a multi-page
+TIFF file, a 3D `.npy` file or a directory of images, are segmented in
+parallel by a pool of worker processes with the usual 2D workflow. The grains
+of consecutive slices are linked by their overlap, so that a grain keeps its
+label through the stack, and each slice is written into a memory-mapped 3D
+label volume as soon as it is linked. Only the slices being processed are
+held in memory, never the whole stack or volume.
+
+Example:
+    python stack.py stack.tif -o volume.npy -p parameters.json -j 8
+"""
+
+import argparse
+import multiprocessing
+import os
+import os.path as path
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from batch import find_images, limit_threads, load_parameters, run_pipeline, worker_environment
+from image_io import open_image, open_output
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+class SliceReader:
+    """Reads the slices of a stack one by one.
+
+    Attributes
+    ----------
+    source : str
+        Multi-page TIFF file, 3D `.npy` file or directory of 2D images.
+    files : list of str or None
+        The images of the directory, in the order of the slices: sorted by
+        name, numbers in the names being compared by value (slice_2 before
+        slice_10).
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.files = None
+        extension = path.splitext(source)[1][1:].lower()
+        if path.isdir(source):
+            self.files = sorted(find_images([source]), key=_natural_key)
+            self._length = len(self.files)
+        elif extension == 'npy':
+            self._length = np.load(source, mmap_mode='r').shape[0]
+        elif extension in ['tif', 'tiff']:
+            if tifffile is None:
+                raise Exception('Reading multi-page TIFF files needs the tifffile package.')
+            with tifffile.TiffFile(source) as tiff:
+                self._length = len(tiff.pages)
+        else:
+            raise Exception('Unsupported stack {0}. Use a directory, a .npy or a TIFF file.'.format(source))
+        if self._length == 0:
+            raise Exception('The stack {0} has no slices.'.format(source))
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        """The slice as an RGB image; grey-level slices are repeated in the three channels."""
+        return read_slice(*self.locate(index))
+
+    def locate(self, index):
+        """The file holding a slice and the index of the slice in it (None for a 2D image)."""
+        if self.files is not None:
+            return self.files[index], None
+        return self.source, index
+
+
+def read_slice(file, index=None):
+    """A slice located by `SliceReader.locate`, as an RGB image."""
+    if index is None:
+        image = open_image(file)
+    elif file.lower().endswith('.npy'):
+        image = np.array(np.load(file, mmap_mode='r')[index])
+    else:
+        image = tifffile.imread(file, key=index)
+    if image.ndim == 2:
+        image = np.stack([image] * 3, axis=-1)
+    return np.ascontiguousarray(image[..., :3])
+
+
+def _natural_key(name):
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+
+
+def segment_slice(location, parameters):
+    """Watershed labels of the slice at `location` (see `SliceReader.locate`). Runs in a worker process."""
+    from grain_segmentation import GrainSegmentation
+
+    segmenter = GrainSegmentation.from_array(read_slice(*location))
+    return run_pipeline(segmenter, parameters)
+
+
+def link_labels(previous, current, min_fraction=0.5):
+    """Match the grains of a slice to those of the previous slice.
+
+    A grain of `current` is matched to the grain of `previous` it overlaps
+    most, if that overlap is at least `min_fraction` of its overlap with all
+    the grains (see `tiling.match_labels`). Each grain of `previous` is
+    matched at most once, to the grain of `current` overlapping it most, so
+    that grains appearing next to an existing one get a label of their own.
+
+    Parameters
+    ----------
+    previous : int ndarray
+        Labels of the previous slice. Zero is ignored.
+    current : int ndarray
+        Labels of the current slice, with the same shape. Zero is ignored.
+    min_fraction : float, optional
+        Minimum overlap fraction of a match.
+
+    Returns
+    -------
+    lut : int ndarray
+        `lut[c]` is the label of `previous` matched to the label `c` of
+        `current`, or 0 if there is none.
+    """
+
+    n_current = int(current.max()) + 1 if current.size else 1
+    lut = np.zeros(n_current, dtype=np.int64)
+    known = (previous > 0) & (current > 0)
+    if not known.any():
+        return lut
+    prev = previous[known].astype(np.int64)
+    cur = current[known].astype(np.int64)
+    width = int(prev.max()) + 1
+    pairs, counts = np.unique(cur * width + prev, return_counts=True)
+    pair_cur, pair_prev = np.divmod(pairs, width)
+    area = np.bincount(cur, minlength=n_current)
+    # Most overlapping previous grain of each current grain (the last after sorting)
+    order = np.lexsort((counts, pair_cur))
+    best = order[np.r_[pair_cur[order][1:] != pair_cur[order][:-1], True]]
+    best = best[counts[best] >= min_fraction * area[pair_cur[best]]]
+    # Most overlapping current grain of each previous grain among those
+    order = best[np.lexsort((counts[best], pair_prev[best]))]
+    best = order[np.r_[pair_prev[order][1:] != pair_prev[order][:-1], True]]
+    lut[pair_cur[best]] = pair_prev[best]
+    return lut
+
+
+class SliceLinker:
+    """Write the labels of consecutive slices into a 3D volume with linked grains.
+
+    Attributes
+    ----------
+    out : 3D int ndarray
+        The label volume, possibly memory-mapped.
+    n_labels : int
+        Number of labels used so far.
+    min_fraction : float
+        Overlap fraction needed to link grains, see `link_labels`.
+    """
+
+    def __init__(self, out, min_fraction=0.5):
+        self.out = out
+        self.n_labels = 0
+        self.min_fraction = min_fraction
+        self._previous = None
+
+    def add(self, index, labels):
+        """Write the labels of slice `index`; the slices must be added in order."""
+        if self._previous is None:
+            lut = np.zeros(int(labels.max()) + 1, dtype=np.int64)
+        else:
+            lut = link_labels(self._previous, labels, self.min_fraction)
+        present = np.zeros(lut.size, dtype=bool)
+        present[labels] = True
+        new = present & (lut == 0)
+        new[0] = False
+        lut[new] = self.n_labels + np.arange(1, np.count_nonzero(new) + 1)
+        self.n_labels += np.count_nonzero(new)
+        linked = lut[labels]
+        self.out[index] = linked
+        self._previous = linked
+
+
+def segment_stack(source, out, parameters=None, workers=None, threads=1, min_fraction=0.5):
+    """Segment the slices of a stack in parallel and link them into a label volume.
+
+    Parameters
+    ----------
+    source : str
+        Multi-page TIFF file, 3D `.npy` file or directory of images, see `SliceReader`.
+    out : str
+        Path of the `.npy` file of the label volume, created and memory-mapped.
+    parameters : dict, optional
+        Keyword arguments of the steps, see `batch.load_parameters`.
+    workers : int, optional
+        Number of worker processes. Defaults to the number of CPUs.
+    threads : int, optional
+        Number of threads each worker may use in the numerical libraries.
+    min_fraction : float, optional
+        Overlap fraction needed to link grains of consecutive slices.
+
+    Returns
+    -------
+    np.memmap
+        The label volume, labelled from 1.
+    """
+
+    reader = SliceReader(source)
+    if parameters is None:
+        parameters = load_parameters()
+    workers = workers or os.cpu_count()
+    volume = open_output(out, (len(reader),) + reader[0].shape[:2], np.int32)
+    linker = SliceLinker(volume, min_fraction)
+    context = multiprocessing.get_context('spawn')
+    with worker_environment(threads), \
+            ProcessPoolExecutor(workers, mp_context=context, initializer=limit_threads,
+                                initargs=(threads,)) as executor:
+        # A few slices are submitted ahead, so that few finished slices wait to be linked
+        futures = {}
+        submitted = 0
+        for index in range(len(reader)):
+            while submitted < min(index + 2 * workers, len(reader)):
+                futures[submitted] = executor.submit(segment_slice, reader.locate(submitted), parameters)
+                submitted += 1
+            linker.add(index, futures.pop(index).result())
+            print('Slice {0} of {1}: {2} grains so far'.format(index + 1, len(reader), linker.n_labels))
+    volume.flush()
+    return volume
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Segment a 3D stack slice by slice.')
+    parser.add_argument('source', help='multi-page TIFF file, 3D .npy file or directory of images')
+    parser.add_argument('-o', '--output', required=True, help='.npy file of the label volume')
+    parser.add_argument('-p', '--parameters', help='JSON file with the parameters of the steps')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('-t', '--threads', type=int, default=1,
+                        help='threads per worker in the numerical libraries (default: 1)')
+    parser.add_argument('--min-fraction', type=float, default=0.5,
+                        help='overlap fraction needed to link grains of consecutive slices (default: 0.5)')
+    args = parser.parse_args(argv)
+
+    volume = segment_stack(args.source, args.output, load_parameters(args.parameters), args.workers,
+                           args.threads, args.min_fraction)
+    print('Done: label volume of shape {0} written to {1}'.format(volume.shape, args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Regression tests of the watershed markers: the fast labelling of the extended
+minima must give the same markers as labelling the output of `imextendedmin`.
+
+Run with pytest, or as a script.
+"""
+
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+from skimage import measure
+
+from gala_light import extended_minima_markers, imextendedmin, label_regional_minima, regional_minima
+from minima_tree import MinimaTree
+
+
+def skeleton_distance(seed, shape=(80, 80), n_lines=12):
+    """Negative distance function to random straight lines, like that of a skeleton."""
+    rng = np.random.default_rng(seed)
+    skeleton = np.zeros(shape, dtype=bool)
+    for _ in range(n_lines):
+        start, stop = rng.integers(0, shape, size=(2, 2))
+        length = int(np.abs(stop - start).max()) + 1
+        rows, cols = np.linspace(start, stop, length).round().astype(int).T
+        skeleton[rows, cols] = True
+    return np.negative(distance_transform_edt(~skeleton))
+
+
+def test_regional_minima():
+    for seed in range(20):
+        image = skeleton_distance(seed)
+        assert np.array_equal(label_regional_minima(image), measure.label(regional_minima(image)))
+
+
+def test_extended_minima_markers():
+    for seed in range(20):
+        image = skeleton_distance(seed)
+        for h in (1, 2, 3.5):
+            expected = measure.label(imextendedmin(image, h))
+            assert np.array_equal(extended_minima_markers(image, h), expected)
+            assert np.array_equal(extended_minima_markers(image, h, method='iterative'), expected)
+
+
+def test_minima_tree_markers():
+    for seed in range(20):
+        image = skeleton_distance(seed)
+        tree = MinimaTree(image)
+        for h in (1, 2, 3.5):
+            assert np.array_equal(tree.markers(h), measure.label(imextendedmin(image, h)))
+
+
+if __name__ == '__main__':
+    test_regional_minima()
+    test_extended_minima_markers()
+    test_minima_tree_markers()
+    print('All marker tests passed.')
@@ -0,0 +1,277 @@
+"""
+Tiled execution of the segmentation pipeline.
+
+Large images are split into tiles that overlap by a halo. Every tile is
+processed on its own, then the labels are stitched across the tile seams into
+one consistent label image. This allows
+ - segmenting mosaics out of core: only the tile being processed is held in
+   memory, so when the input and the output are memory-mapped arrays, the peak
+   memory is set by the tile size and not by the size of the mosaic;
+ - running the quick shift segmentation on the tiles in parallel.
+"""
+
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from skimage import segmentation
+
+
+Tile = namedtuple('Tile', ['outer', 'inner', 'core'])
+Tile.__doc__ = """Position of a tile.
+
+outer : tuple of slice
+    Region of the tile including the halo, in image coordinates.
+inner : tuple of slice
+    Region owned by the tile (no halo), in image coordinates.
+core : tuple of slice
+    Region owned by the tile, in the coordinates of the outer region.
+"""
+
+
+def iter_tiles(shape, tile_size, halo):
+    """Split a 2D domain into tiles, in row-major order.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the image. Only the first two dimensions are split.
+    tile_size : int
+        Size of the region owned by each tile.
+    halo : int
+        Width of the overlap added around each tile, clipped at the image border.
+
+    Yields
+    ------
+    Tile
+        The position of the next tile.
+    """
+
+    rows, cols = shape[:2]
+    for row in range(0, rows, tile_size):
+        for col in range(0, cols, tile_size):
+            inner = (slice(row, min(row + tile_size, rows)), slice(col, min(col + tile_size, cols)))
+            outer = (slice(max(row - halo, 0), min(row + tile_size + halo, rows)),
+                     slice(max(col - halo, 0), min(col + tile_size + halo, cols)))
+            core = tuple(slice(i.start - o.start, i.stop - o.start) for i, o in zip(inner, outer))
+            yield Tile(outer, inner, core)
+
+
+def expand(region, margin, shape):
+    """Enlarge a region by a margin, clipped to the image.
+
+    Returns
+    -------
+    expanded : tuple of slice
+        The enlarged region, in image coordinates.
+    crop : tuple of slice
+        The original region, in the coordinates of the enlarged one.
+    """
+
+    expanded = tuple(slice(max(s.start - margin, 0), min(s.stop + margin, n))
+                     for s, n in zip(region, shape))
+    crop = tuple(slice(s.start - e.start, s.stop - e.start) for s, e in zip(region, expanded))
+    return expanded, crop
+
+
+def match_labels(reference, candidate, min_fraction=0.5):
+    """Match the candidate labels to the reference labels by overlap.
+
+    Parameters
+    ----------
+    reference : int ndarray
+        Known labels. Zero means unknown and is ignored.
+    candidate : int ndarray
+        Labels to be matched, with the same shape as `reference`. Zero is ignored.
+    min_fraction : float, optional
+        A candidate label is matched to the reference label covering at least
+        this fraction of the pixels where the candidate and the reference overlap.
+
+    Returns
+    -------
+    lut : int ndarray
+        `lut[c]` is the reference label matched to the candidate label `c`, or
+        0 if there is none.
+    """
+
+    n_candidates = int(candidate.max()) + 1 if candidate.size else 1
+    lut = np.zeros(n_candidates, dtype=np.int64)
+    known = (reference > 0) & (candidate > 0)
+    if not known.any():
+        return lut
+    ref = reference[known].astype(np.int64)
+    cand = candidate[known].astype(np.int64)
+    pairs, counts = np.unique(cand * (int(ref.max()) + 1) + ref, return_counts=True)
+    pair_cand, pair_ref = np.divmod(pairs, int(ref.max()) + 1)
+    area = np.bincount(cand, minlength=n_candidates)
+    # For each candidate, keep its most overlapping reference label (the last after sorting)
+    order = np.lexsort((counts, pair_cand))
+    best = order[np.r_[pair_cand[order][1:] != pair_cand[order][:-1], True]]
+    good = counts[best] >= min_fraction * area[pair_cand[best]]
+    lut[pair_cand[best][good]] = pair_ref[best][good]
+    return lut
+
+
+class LabelStitcher:
+    """Stitch tile label images into a global label image.
+
+    The tiles must be added in row-major order. The labels of a new tile that
+    overlap the already written tiles are matched to the global labels there
+    (see `match_labels`), the other labels get new global values.
+
+    Attributes
+    ----------
+    out : int ndarray
+        The global label image, zero where nothing has been written yet.
+    n_labels : int
+        Number of global labels used so far.
+    """
+
+    def __init__(self, out, min_fraction=0.5):
+        """
+        Parameters
+        ----------
+        out : int ndarray
+            Zero-initialized output, possibly memory-mapped.
+        min_fraction : float, optional
+            Overlap fraction needed to match labels, see `match_labels`.
+        """
+
+        self.out = out
+        self.n_labels = 0
+        self.min_fraction = min_fraction
+
+    def add(self, tile, labels):
+        """Write the labels of a tile into the global label image.
+
+        Parameters
+        ----------
+        tile : Tile
+            Position of the tile.
+        labels : int ndarray
+            Labels of the outer region of the tile, positive for grains.
+        """
+
+        lut = match_labels(np.asarray(self.out[tile.outer]), labels, self.min_fraction)
+        core = labels[tile.core]
+        # Labels that appear in the core but could not be matched get new global values
+        present = np.zeros(lut.size, dtype=bool)
+        present[core] = True
+        new = present & (lut == 0)
+        new[0] = False
+        lut[new] = self.n_labels + np.arange(1, np.count_nonzero(new) + 1)
+        self.n_labels += np.count_nonzero(new)
+        self.out[tile.inner] = lut[core]
+
+
+def _quickshift_tile(image, kwargs):
+    """Quick shift segmentation of a tile, with positive labels."""
+    return segmentation.quickshift(image, **kwargs) + 1
+
+
+def quickshift_tiled(image, tile_size=512, overlap=32, workers=None, processes=False, **kwargs):
+    """Quick shift segmentation of overlapping tiles in parallel.
+
+    The superpixels of the tiles are matched in the overlap zones (see
+    `LabelStitcher`), giving one label image with globally unique labels.
+
+    Parameters
+    ----------
+    image : 3D ndarray with size 3 in the third dimension
+        Input image.
+    tile_size : int, optional
+        Size of the region owned by each tile.
+    overlap : int, optional
+        Width of the overlap around the tiles. It should exceed the reach of
+        quick shift, i.e. about `3 * kernel_size + max_dist`.
+    workers : int, optional
+        Number of threads or processes. Defaults to the number of CPUs.
+    processes : bool, optional
+        Use processes instead of threads. Threads are usually enough, as quick
+        shift releases the GIL.
+    **kwargs
+        Parameters of `segmentation.quickshift`.
+
+    Returns
+    -------
+    segment_mask : int ndarray
+        Label image, with labels starting from 0 like that of quick shift.
+    """
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    tiles = list(iter_tiles(image.shape, tile_size, overlap))
+    stitcher = LabelStitcher(np.zeros(image.shape[:2], dtype=np.int32))
+    executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor_class(workers) as executor:
+        # A few tiles are submitted ahead, so that only the tiles being processed are copied in memory
+        futures = {}
+        submitted = 0
+        for index, tile in enumerate(tiles):
+            while submitted < min(index + 2 * workers, len(tiles)):
+                futures[submitted] = executor.submit(_quickshift_tile,
+                                                     np.ascontiguousarray(image[tiles[submitted].outer]), kwargs)
+                submitted += 1
+            # The tiles are stitched in their order, as the stitching requires
+            stitcher.add(tile, futures.pop(index).result())
+    return stitcher.out - 1
+
+
+def segment_tiled(image, tile_size=2048, halo=64, out=None, window_size=5, threshold=5):
+    """Run the whole segmentation pipeline tile by tile.
+
+    The steps are the same as in the usual workflow: median filtering, quick
+    shift segmentation, merging of the clusters, grain boundaries, skeleton
+    and watershed segmentation.
+
+    Parameters
+    ----------
+    image : 3D array-like with size 3 in the third dimension, or str
+        The image to be segmented, or the path to it. Files are memory-mapped
+        when the format allows it, see `image_io.open_image`.
+    tile_size : int, optional
+        Size of the region owned by each tile.
+    halo : int, optional
+        Width of the overlap around the tiles, shared by the segmentation steps.
+        It should be larger than the typical grain so that the grains along the
+        seams are seen whole by at least one tile. The median filter reads an
+        extra `window_size // 2` pixels, so the filtering is exact.
+    out : 2D int array-like or str, optional
+        Zero-initialized output, or the path to a `.npy` file to be created
+        and memory-mapped for it. If not given, an in-memory array is used.
+    window_size : int, optional
+        Window size of the median filter.
+    threshold : float, optional
+        Threshold for merging the clusters.
+
+    Returns
+    -------
+    out : 2D int array-like
+        The stitched label image.
+    """
+
+    # Imported here as the GrainSegmentation class itself uses this module
+    from grain_segmentation import GrainSegmentation
+    from image_io import open_image, open_output
+
+    if isinstance(image, str):
+        image = open_image(image, mmap=True)
+    shape = image.shape
+    if out is None:
+        out = np.zeros(shape[:2], dtype=np.int32)
+    elif isinstance(out, str):
+        out = open_output(out, shape[:2], np.int32)
+    stitcher = LabelStitcher(out)
+    for tile in iter_tiles(shape, tile_size, halo):
+        # The filter needs its own footprint around the region the other steps see
+        filter_region, crop = expand(tile.outer, window_size // 2, shape)
+        region = np.asarray(image[filter_region])
+        segmenter = GrainSegmentation.from_array(region[crop], interactive_mode=False)
+        filtered = segmenter.filter_image(window_size, region)[crop]
+        segmented = segmenter.initial_segmentation(filtered)
+        merged = segmenter.merge_clusters(segmented, threshold)
+        boundary = segmenter.find_grain_boundaries(merged)
+        skeleton = segmenter.create_skeleton(boundary)
+        stitcher.add(tile, segmenter.watershed_segmentation(skeleton))
+    return out